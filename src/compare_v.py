@@ -178,9 +178,14 @@ def compare_ref(v1, v2):
         return False
     # Add bel properties
     if v1["IS_PRIMITIVE"] == 1:
+        # Parametric templates allow a set of values for some properties
+        params = v2.attributes().get("PARAM_PROPERTIES") or {}
         for P in v1["BEL_PROPERTIES"]:
             if P in v2["BEL_PROPERTIES"]:
-                if P == "CONFIG.EQN":
+                if P in params:
+                    if v1["BEL_PROPERTIES"][P] not in params[P]:
+                        return 0
+                elif P == "CONFIG.EQN":
                     # print("===============")
                     # print(v1["BEL_PROPERTIES"][P])
                     # print(v2["BEL_PROPERTIES"][P])
@@ -283,7 +288,7 @@ def compare_vertex(mapping, g1, v1, g2, v2, depth, verbose):
                             return 0
                         mapping[e1_source] = e2_source
                         tmp_map = compare_vertex(
-                            dict(mapping),
+                            mapping.copy(),
                             g1,
                             g1.vs[e1_source],
                             g2,
@@ -321,7 +326,7 @@ def compare_vertex(mapping, g1, v1, g2, v2, depth, verbose):
                                 continue
                             mapping[e1_source] = e2_source
                             tmp_map = compare_vertex(
-                                dict(mapping),
+                                mapping.copy(),
                                 g1,
                                 g1.vs[e1_source],
                                 g2,
@@ -401,7 +406,7 @@ def compare_vertex(mapping, g1, v1, g2, v2, depth, verbose):
                             return 0
                         mapping[e1_target] = e2_target
                         tmp_map = compare_vertex(
-                            dict(mapping),
+                            mapping.copy(),
                             g1,
                             g1.vs[e1_target],
                             g2,
@@ -451,7 +456,7 @@ def compare_vertex(mapping, g1, v1, g2, v2, depth, verbose):
                                 continue
                             mapping[e1_target] = e2_target
                             tmp_map = compare_vertex(
-                                dict(mapping),
+                                mapping.copy(),
                                 g1,
                                 g1.vs[e1_target],
                                 g2,
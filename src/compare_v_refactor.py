@@ -30,12 +30,40 @@ for i in list1:
 Familiarize yourself with the syntax here: https://stackoverflow.com/a/1859099
 """
 
-from itertools import zip_longest
+import hashlib
 import re
+import weakref
+from collections import OrderedDict
+from itertools import islice
 from igraph import Graph
 
 
 LUT_IN_PIN_NAMES = ["A6", "A5", "A4", "A3", "A2", "A1"]
+# Integer labels of (in_pin, out_pin, signal) edge keys, see edge_label
+EDGE_LABELS = {}
+CONSTANT_REFS = {"GND", "VCC"}
+# Vertex attributes read while matching, kept as lists by GraphColumns
+COLUMN_ATTRS = (
+    "ref",
+    "color",
+    "IS_PRIMITIVE",
+    "CONFIG.EQN",
+    "EQN_PIN_DICT",
+    "BEL_PROPERTIES",
+    "PARAM_EQN",
+    "PARAM_PROPERTIES",
+    "in_adj",
+    "out_adj",
+    "origin",
+)
+# Numbered BEL_PROPERTIES key sets: frozenset of keys -> (number, sorted keys)
+PROPERTY_KEYS = {}
+# Pairs kept by FailureCache, a few hundred bytes each
+FAILURE_CACHE_SIZE = 100000
+# Length of the walks counted by SignatureIndex
+SIGNATURE_HOPS = 2
+# Column views by id(graph): (weak reference to the graph, GraphColumns)
+GRAPH_COLUMNS = {}
 
 
 def convert_lut_eqn(eqn):
@@ -228,15 +256,110 @@ def print_graph(graph_obj, f):
 
 
 ######### iGraph Comparison Functions #########
+class MappedValues:
+    """values() view of a VertexMapping, with O(1) membership tests"""
+
+    def __init__(self, mapping):
+        self.mapping = mapping
+
+    def __contains__(self, value):
+        return value in self.mapping.inverse
+
+    def __iter__(self):
+        return iter(dict.values(self.mapping))
+
+    def __len__(self):
+        return len(self.mapping)
+
+
+class VertexMapping(dict):
+    """
+    Bijective mapping of lh (design) to rh (template) vertex indices.
+
+    inverse holds the reverse mapping, so both directions are looked up in
+    O(1).  values() also tests membership through inverse, which keeps code
+    written for plain dict mappings working (and fast).  Mappings pickle as
+    plain dicts wrapped in VertexMapping, so a mapping saved from a plain
+    dict (e.g. an old checkpoint) is loaded with VertexMapping(mapping).
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__()
+        self.inverse = {}
+        self.update(*args, **kwargs)
+
+    def __setitem__(self, key, value):
+        if self.inverse.get(value, key) != key:
+            raise ValueError(f"{value} is already mapped from {self.inverse[value]}")
+        if key in self:
+            del self.inverse[self[key]]
+        super().__setitem__(key, value)
+        self.inverse[value] = key
+
+    def __delitem__(self, key):
+        del self.inverse[self[key]]
+        super().__delitem__(key)
+
+    def __reduce__(self):
+        return (VertexMapping, (dict(self),))
+
+    def pop(self, key, *default):
+        if key not in self:
+            if default:
+                return default[0]
+            raise KeyError(key)
+        value = super().pop(key)
+        del self.inverse[value]
+        return value
+
+    def popitem(self):
+        key, value = super().popitem()
+        del self.inverse[value]
+        return key, value
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def clear(self):
+        super().clear()
+        self.inverse.clear()
+
+    def copy(self):
+        mapping = VertexMapping()
+        dict.update(mapping, self)
+        mapping.inverse = dict(self.inverse)
+        return mapping
+
+    def values(self):
+        return MappedValues(self)
+
+    def added_since(self, n):
+        """
+        rh vertices matched since the mapping had n matches, newest first.
+        Holds while matches are only added (and undone last first), as
+        compare_vertex does, since inverse keeps the order they were made in.
+        """
+        return list(islice(reversed(self.inverse), len(self) - n))
+
+
 def compare_eqn(v1, v2):
-    eq1 = v1["CONFIG.EQN"]
-    eq2 = v2["CONFIG.EQN"]
+    return compare_eqn_values(
+        v1["CONFIG.EQN"], v1["EQN_PIN_DICT"], v2["CONFIG.EQN"], v2["EQN_PIN_DICT"]
+    )
+
+
+def compare_eqn_values(eq1, eq1_pin_dict, eq2, eq2_pin_dict):
     if eq1 != eq2:
         return False
-    eq1_pin_dict = v1["EQN_PIN_DICT"]
-    eq2_pin_dict = dict(v2["EQN_PIN_DICT"])
+    eq2_pin_dict = dict(eq2_pin_dict)
     for pin1_eq in eq1_pin_dict.values():
-        for pin2, pin2_eq in eq2_pin_dict:
+        for pin2, pin2_eq in eq2_pin_dict.items():
             if pin1_eq == pin2_eq:
                 eq2_pin_dict.pop(pin2, None)
                 break
@@ -245,155 +368,854 @@ def compare_eqn(v1, v2):
     return True
 
 
-def compare_ref(lh_vertex, rh_vertex):
-    """Compare two vertices' primitive references"""
-    if lh_vertex["ref"] != rh_vertex["ref"]:
+class GraphColumns:
+    """
+    Read-only column view of the vertex attributes read while matching: one
+    list per attribute of COLUMN_ATTRS, indexed by vertex id, with None where
+    a vertex does not have the attribute.  Reading a list element is much
+    cheaper than building an igraph.Vertex to look the attribute up.  The
+    view also holds the "PROP_FINGERPRINT" of every vertex, see
+    property_fingerprint.
+
+    The view is a snapshot, see get_columns.  A graph edited after its view
+    is built keeps it in step with set_vertex_attr, extend_columns and
+    truncate_columns, as replace_hier_cell and GraphOverlay do.
+    """
+
+    def __init__(self, g):
+        n = g.vcount()
+        attrs = set(g.vs.attributes())
+        self.columns = {x: g.vs[x] if x in attrs else [None] * n for x in COLUMN_ATTRS}
+        self.columns["PROP_FINGERPRINT"] = list(
+            map(property_fingerprint, self.columns["BEL_PROPERTIES"])
+        )
+
+    @classmethod
+    def of_vertex(cls, vertex):
+        """Single row view of one vertex, at index 0"""
+        columns = cls.__new__(cls)
+        attrs = vertex.attributes()
+        columns.columns = {x: [attrs.get(x)] for x in COLUMN_ATTRS}
+        columns.columns["PROP_FINGERPRINT"] = [property_fingerprint(attrs.get("BEL_PROPERTIES"))]
+        return columns
+
+    def __getitem__(self, attr):
+        return self.columns[attr]
+
+    def __len__(self):
+        return len(self.columns["ref"])
+
+    def copy(self):
+        columns = GraphColumns.__new__(GraphColumns)
+        columns.columns = {x: list(column) for x, column in self.columns.items()}
+        return columns
+
+    def set(self, v_id, attr, value):
+        if attr in COLUMN_ATTRS and v_id < len(self):
+            self.columns[attr][v_id] = value
+            if attr == "BEL_PROPERTIES":
+                self.columns["PROP_FINGERPRINT"][v_id] = property_fingerprint(value)
+
+    def extend(self, g):
+        start = len(self)
+        vs = g.vs[start:]
+        attrs = set(g.vs.attributes())
+        for attr in COLUMN_ATTRS:
+            self.columns[attr].extend(vs[attr] if attr in attrs else [None] * len(vs))
+        self.columns["PROP_FINGERPRINT"].extend(
+            map(property_fingerprint, self.columns["BEL_PROPERTIES"][start:])
+        )
+
+    def truncate(self, n):
+        for column in self.columns.values():
+            del column[n:]
+
+    def adjacency(self, g, v_id):
+        """("in", "out") pin keyed adjacency of a vertex, see index_edges"""
+        in_adj = self.columns["in_adj"][v_id]
+        if in_adj is None:
+            in_adj = vertex_adjacency(g.vs[v_id], "in")
+        out_adj = self.columns["out_adj"][v_id]
+        if out_adj is None:
+            out_adj = vertex_adjacency(g.vs[v_id], "out")
+        return in_adj, out_adj
+
+
+def property_fingerprint(props):
+    """
+    Fingerprint of a BEL_PROPERTIES dict: (key set id, hash of the values in
+    key order).  Key sets are numbered in PROPERTY_KEYS, so two dicts with
+    the same key set id have the same keys, and can only be equal if their
+    value hashes are.  None for a vertex without properties, or with a value
+    that is not hashable.
+    """
+    if props is None:
+        return None
+    keys = frozenset(props)
+    key_set = PROPERTY_KEYS.get(keys)
+    if key_set is None:
+        key_set = PROPERTY_KEYS[keys] = (len(PROPERTY_KEYS), tuple(sorted(keys)))
+    try:
+        return key_set[0], hash(tuple(props[x] for x in key_set[1]))
+    except TypeError:
+        return None
+
+
+def _drop_columns(key, graph_ref):
+    if GRAPH_COLUMNS.get(key, (None,))[0] is graph_ref:
+        del GRAPH_COLUMNS[key]
+
+
+def cached_columns(g):
+    """Column view of g if one was built, otherwise None"""
+    entry = GRAPH_COLUMNS.get(id(g))
+    if entry is None or entry[0]() is not g:
+        return None
+    return entry[1]
+
+
+def set_columns(g, columns):
+    key = id(g)
+    GRAPH_COLUMNS[key] = (weakref.ref(g, lambda graph_ref: _drop_columns(key, graph_ref)), columns)
+    return columns
+
+
+def get_columns(g):
+    """
+    Column view of g, see GraphColumns.  It is built on first use and kept
+    until g is freed; a view that lost track of added or deleted vertices is
+    rebuilt.
+    """
+    columns = cached_columns(g)
+    if columns is None or len(columns) != g.vcount():
+        columns = set_columns(g, GraphColumns(g))
+    return columns
+
+
+def drop_columns(g):
+    """Forget the column view of g, for edits that renumber its vertices"""
+    GRAPH_COLUMNS.pop(id(g), None)
+
+
+def copy_columns(g, g_copy):
+    """Give g_copy (a copy of g) a copy of the column view of g"""
+    columns = cached_columns(g)
+    if columns is not None and len(columns) == g.vcount():
+        set_columns(g_copy, columns.copy())
+
+
+def set_vertex_attr(g, v_id, attr, value):
+    """Set a vertex attribute of g, and in its column view"""
+    g.vs[v_id][attr] = value
+    columns = cached_columns(g)
+    if columns is not None:
+        columns.set(v_id, attr, value)
+
+
+def extend_columns(g):
+    """Add the vertices appended to g to its column view"""
+    columns = cached_columns(g)
+    if columns is not None:
+        columns.extend(g)
+
+
+def truncate_columns(g):
+    """Remove the vertices deleted from the end of g from its column view"""
+    columns = cached_columns(g)
+    if columns is not None:
+        columns.truncate(g.vcount())
+
+
+def compare_ref_columns(lh_columns, lh_idx, rh_columns, rh_idx):
+    """compare_ref of vertices given by their column views and indices"""
+    if lh_columns["ref"][lh_idx] != rh_columns["ref"][rh_idx]:
         return False
 
-    if not lh_vertex["IS_PRIMITIVE"]:
+    if not lh_columns["IS_PRIMITIVE"][lh_idx]:
         return True
 
-    if lh_vertex["CONFIG.EQN"]:
-        if not compare_eqn(lh_vertex, rh_vertex):
+    # Parametric templates allow a set of equations and property values
+    lh_eqn = lh_columns["CONFIG.EQN"][lh_idx]
+    if lh_eqn:
+        lh_pin_dict = lh_columns["EQN_PIN_DICT"][lh_idx]
+        eqns = rh_columns["PARAM_EQN"][rh_idx]
+        if eqns:
+            if not any(
+                compare_eqn_values(lh_eqn, lh_pin_dict, x["CONFIG.EQN"], x["EQN_PIN_DICT"])
+                for x in eqns
+            ):
+                return False
+        elif not compare_eqn_values(
+            lh_eqn,
+            lh_pin_dict,
+            rh_columns["CONFIG.EQN"][rh_idx],
+            rh_columns["EQN_PIN_DICT"][rh_idx],
+        ):
             return False
 
-    props1 = lh_vertex["BEL_PROPERTIES"]
-    props2 = rh_vertex["BEL_PROPERTIES"]
+    props1 = lh_columns["BEL_PROPERTIES"][lh_idx]
+    props2 = rh_columns["BEL_PROPERTIES"][rh_idx]
+    params = rh_columns["PARAM_PROPERTIES"][rh_idx] or {}
+    fingerprint1 = lh_columns["PROP_FINGERPRINT"][lh_idx]
+    fingerprint2 = rh_columns["PROP_FINGERPRINT"][rh_idx]
+    if not params and fingerprint1 and fingerprint2 and fingerprint1[0] == fingerprint2[0]:
+        # Same keys on both sides, so all values must be equal: hashes first
+        return fingerprint1[1] == fingerprint2[1] and props1 == props2
     keys = props1.keys() & props2.keys()
     for prop in keys:
-        if props1[prop] != props2[prop]:
+        if prop in params:
+            if props1[prop] not in params[prop]:
+                return False
+        elif props1[prop] != props2[prop]:
             return False
     return True
 
 
+def compare_ref(lh_vertex, rh_vertex):
+    """Compare two vertices' primitive references"""
+    return compare_ref_columns(
+        GraphColumns.of_vertex(lh_vertex), 0, GraphColumns.of_vertex(rh_vertex), 0
+    )
+
+
 def is_constant_vertex(lh_vertex):
-    return lh_vertex["ref"] in ["GND", "VCC"]
+    return lh_vertex["ref"] in CONSTANT_REFS
+
 
+def edge_label(in_pin, out_pin, signal):
+    """
+    Integer label of the pins and signal of an edge.  Labels are hashes of
+    the key rather than counters, so they agree between processes and across
+    pickled graphs.
+    """
+    key = (in_pin, out_pin, signal)
+    label = EDGE_LABELS.get(key)
+    if label is None:
+        digest = hashlib.blake2b(f"{in_pin}.{out_pin}.{signal}".encode(), digest_size=8)
+        label = EDGE_LABELS[key] = int.from_bytes(digest.digest(), "little")
+    return label
 
-def create_edge_dict(edge_list1, edge_list2):
-    edge_dict = {}
-    for e1, e2 in zip_longest(edge_list1, edge_list2, fillvalue={"signal": "port"}):
-        if e2["signal"] != "port":
-            key = f'{e2["in_pin"]}.{e2["out_pin"]}.{e2["signal"]}'
-            edge_dict.setdefault(key, {"e2": [], "e1": []})["e2"].append(e2.source)
-        if e1["signal"] != "port":
-            key = f'{e1["in_pin"]}.{e1["out_pin"]}.{e1["signal"]}'
-            edge_dict.setdefault(key, {"e2": [], "e1": []})["e1"].append(e1.source)
-    return edge_dict
 
+def group_edges(labeled_neighbors):
+    """Group (label, neighbor) pairs into ((label, (neighbors)), ...) in order"""
+    groups = {}
+    for label, neighbor in labeled_neighbors:
+        groups.setdefault(label, []).append(neighbor)
+    return tuple((label, tuple(neighbors)) for label, neighbors in groups.items())
 
-def compare_edges(lh_edges, rh_edges, mapping, lh_design, rh_design):
+
+def vertex_adjacency(vertex, mode):
+    """Pin keyed adjacency of one vertex, computed from its edges"""
+    edges = vertex.in_edges() if mode == "in" else vertex.out_edges()
+    return group_edges(
+        (edge_label(e["in_pin"], e["out_pin"], e["signal"]), e.source if mode == "in" else e.target)
+        for e in edges
+        if e["signal"] != "port"
+    )
+
+
+def index_edges(g, vertices=None, overlay=None):
     """
-    Compare vertex edges by examinig edge properties and the connected
-    vertex.
+    Store the pin keyed adjacency of vertices of g (all by default) in the
+    "in_adj" and "out_adj" vertex attributes, read by compare_edges.  Each
+    holds the non-port edges of the vertex grouped by edge label, in edge
+    order: ((label, (neighbors)), ...).  Must be rerun for the vertices whose
+    non-port edges change; with an overlay, the changes are recorded in it.
+    """
+    if vertices is None:
+        labels = [
+            None if signal == "port" else edge_label(in_pin, out_pin, signal)
+            for in_pin, out_pin, signal in zip(g.es["in_pin"], g.es["out_pin"], g.es["signal"])
+        ]
+        edges = g.get_edgelist()
+        adjacency = {}
+        for mode, inc_lists, end in (
+            ("in", g.get_inclist(mode="in"), 0),
+            ("out", g.get_inclist(mode="out"), 1),
+        ):
+            adjacency[mode + "_adj"] = [
+                group_edges((labels[e], edges[e][end]) for e in inc if labels[e] is not None)
+                for inc in inc_lists
+            ]
+        columns = cached_columns(g)
+        for attr, values in adjacency.items():
+            g.vs[attr] = values
+            if columns is not None and len(columns) == len(values):
+                columns.columns[attr] = values
+        return
+    for v_id in vertices:
+        v = g.vs[v_id]
+        for mode in ("in", "out"):
+            if overlay is None:
+                set_vertex_attr(g, v_id, mode + "_adj", vertex_adjacency(v, mode))
+            else:
+                overlay.set_vertex(v_id, mode + "_adj", vertex_adjacency(v, mode))
 
-    lh/rh_edges  ([igraph.Edge]) - Edge list of vertices to compare
-    mapping      ({int: int})    - Current estimated matches of
-                                 verticies between the two graphs.
-                                 mapping[lh_vertex_idx] = rh_vertex_idx
-    lh/rh_design (igraph.Graph)  - Graph of design to compare
+
+class SignatureIndex:
+    """
+    Neighbourhood signatures of the vertices of a graph, computed on demand:
+    the number of walks of up to SIGNATURE_HOPS non-port edges from a vertex,
+    by their sequence of (direction, edge label, ref of the vertex reached).
+    Walks do not go on past GND/VCC, and constant vertices have an empty
+    signature.
+
+    compare_vertex matches every non-port edge of a vertex before moving on
+    to its neighbours, except from constant vertices, and maps vertices one
+    to one.  So a design vertex can only match a template vertex when its
+    signature contains the template vertex's (see contains), which makes it
+    a safe filter of the seeds of a search.
+    """
+
+    def __init__(self, g, hops=SIGNATURE_HOPS):
+        self.g = g
+        self.hops = hops
+        self.walks = {}
+        self.signatures = {}
+
+    def __getitem__(self, v_id):
+        signature = self.signatures.get(v_id)
+        if signature is None:
+            signature = {}
+            if get_columns(self.g)["ref"][v_id] not in CONSTANT_REFS:
+                for length in range(1, self.hops + 1):
+                    signature.update(self.count_walks(v_id, length))
+            self.signatures[v_id] = signature
+        return signature
+
+    def count_walks(self, v_id, length):
+        walks = self.walks.get((v_id, length))
+        if walks is not None:
+            return walks
+        walks = {}
+        columns = get_columns(self.g)
+        refs = columns["ref"]
+        for mode, groups in zip(("in", "out"), columns.adjacency(self.g, v_id)):
+            for label, neighbors in groups:
+                for neighbor in neighbors:
+                    step = (mode, label, refs[neighbor])
+                    if length == 1:
+                        walks[step] = walks.get(step, 0) + 1
+                    elif refs[neighbor] not in CONSTANT_REFS:
+                        for key, count in self.count_walks(neighbor, length - 1).items():
+                            key = step + key
+                            walks[key] = walks.get(key, 0) + count
+        self.walks[(v_id, length)] = walks
+        return walks
+
+    def contains(self, v_id, signature):
+        """Whether vertex v_id has at least the walks counted in signature"""
+        own = self[v_id]
+        return all(own.get(key, 0) >= count for key, count in signature.items())
+
+
+def match_levels(g, v_id, radius=None):
+    """
+    Vertices compare_vertex can reach from v_id, level by level: lists of
+    the vertices first reached after 0, 1, ... steps over non-port edges,
+    up to radius steps.  Constants (GND/VCC) are not stepped past.
+    """
+    columns = get_columns(g)
+    refs = columns["ref"]
+    level = [v_id]
+    seen = {v_id}
+    depth = 0
+    while level:
+        yield level
+        if depth == radius:
+            return
+        depth += 1
+        next_level = []
+        for x in level:
+            if refs[x] in CONSTANT_REFS:
+                continue
+            for groups in columns.adjacency(g, x):
+                for _, neighbors in groups:
+                    for neighbor in neighbors:
+                        if neighbor not in seen:
+                            seen.add(neighbor)
+                            next_level.append(neighbor)
+        level = next_level
+
+
+def match_region(g, v_id, radius=None):
+    """
+    Vertices compare_vertex can reach from v_id: its neighbours over non-port
+    edges, and theirs, except past GND/VCC.  Breadth first, v_id first.
+    """
+    return [x for level in match_levels(g, v_id, radius) for x in level]
+
+
+def refine_domains(lh_design, rh_design, domains):
+    """
+    Prune candidate domains to arc consistency, in place.
+
+    domains maps rh vertices to the set of lh vertices they may be matched
+    to.  An lh vertex stays a candidate of a (non constant) rh vertex only
+    while, for every non-port edge of the rh vertex to another vertex with
+    a domain, it has an edge with the same label to a candidate of that
+    vertex.  compare_vertex checks the same of every pair it matches, so no
+    match it can find is pruned.
     """
-    edge_dict = create_edge_dict(lh_edges, rh_edges)
-    for group in edge_dict.values():
-        lh_edges = group["e1"]
-        for edge_rh in group["e2"]:
-            if not lh_edges:  # NO MATCHING EDGES
+    lh_columns, rh_columns = get_columns(lh_design), get_columns(rh_design)
+    constraints = {}
+    dependents = {x: set() for x in domains}
+    for rh_idx in domains:
+        if rh_columns["ref"][rh_idx] in CONSTANT_REFS:
+            continue
+        constraints[rh_idx] = []
+        for mode, groups in enumerate(rh_columns.adjacency(rh_design, rh_idx)):
+            for label, neighbors in groups:
+                for neighbor in neighbors:
+                    if neighbor in domains:
+                        constraints[rh_idx].append((mode, label, neighbor))
+                        dependents[neighbor].add(rh_idx)
+
+    lh_groups = {}
+
+    def supported(lh_idx, mode, label, rh_neighbor):
+        groups = lh_groups.get(lh_idx)
+        if groups is None:
+            groups = lh_groups[lh_idx] = [dict(x) for x in lh_columns.adjacency(lh_design, lh_idx)]
+        domain = domains[rh_neighbor]
+        return any(x in domain for x in groups[mode].get(label, ()))
+
+    queue = list(constraints)
+    queued = set(queue)
+    while queue:
+        rh_idx = queue.pop()
+        queued.discard(rh_idx)
+        domain = domains[rh_idx]
+        removed = [
+            x
+            for x in domain
+            if not all(supported(x, *constraint) for constraint in constraints[rh_idx])
+        ]
+        if not removed:
+            continue
+        domain.difference_update(removed)
+        for dependent in dependents[rh_idx]:
+            if dependent in constraints and dependent not in queued:
+                queue.append(dependent)
+                queued.add(dependent)
+    return domains
+
+
+def create_edge_dict(lh_adjacency, rh_adjacency):
+    """
+    Group the non-port edges of two vertices by pins and signal.
+
+    Takes the ("in", "out") adjacency of each vertex, see index_edges, and
+    returns [(rh_neighbors, lh_neighbors)] of the "in" (sources) then "out"
+    (targets) neighbors of each group, rh groups first in edge order.
+    """
+    edge_groups = []
+    for lh_groups, rh_groups in zip(lh_adjacency, rh_adjacency):
+        edge_dict = {}
+        for label, neighbors in rh_groups:
+            edge_dict[label] = (list(neighbors), [])
+        for label, neighbors in lh_groups:
+            if label in edge_dict:
+                edge_dict[label][1].extend(neighbors)
+            else:
+                edge_dict[label] = ([], list(neighbors))
+        edge_groups.extend(edge_dict.values())
+    return edge_groups
+
+
+def edge_counts(adjacency):
+    """Number of neighbors of every edge group of an ("in", "out") adjacency"""
+    return tuple(tuple((label, len(neighbors)) for label, neighbors in x) for x in adjacency)
+
+
+def covers_edges(lh_adjacency, rh_adjacency):
+    """
+    Whether the lh vertex has at least as many edges as the rh vertex in
+    every edge group, which compare_edges needs to match them all.
+    """
+    for lh_groups, rh_groups in zip(lh_adjacency, rh_adjacency):
+        found = dict(lh_groups)
+        for label, neighbors in rh_groups:
+            if len(found.get(label, ())) < len(neighbors):
                 return False
-            elif len(lh_edges) == 1:  # ONLY ONE MATCHING EDGE
-                edge_lh = lh_edges[0]
-                if edge_lh in mapping:
-                    if mapping[edge_lh] != edge_rh:
-                        return False
-                    lh_edges.remove(edge_lh)
-                    continue
-                if edge_rh in mapping.values():
-                    return False
+    return True
 
-                tmp_map = compare_vertex(
-                    dict(mapping).update({edge_lh: edge_rh}),
-                    lh_design,
-                    lh_design.vs[edge_lh],
-                    rh_design,
-                    rh_design.vs[edge_rh],
-                )
-                if not tmp_map:
-                    return False
 
-                mapping = tmp_map
-                lh_edges.remove(edge_lh)
-            else:  # MULTIPLE MATCHING EDGES
-                possible_matches = []
-                possible_maps = []
-                for edge_lh in lh_edges:
-                    if edge_lh in mapping:
-                        if mapping[edge_lh] != edge_rh:
-                            continue
-                        possible_matches.append(edge_lh)
-                        lh_edges.remove(edge_lh)
-                        break
-
-                    if edge_rh in mapping.values():
-                        continue
+class FailureCache:
+    """
+    Bounded memory of the vertex pairs compare_vertex found can not match,
+    whatever the rest of the mapping.  Pairs are keyed by stable identities:
+    (lh vertex, "origin" of the rh vertex, edge_counts of the rh vertex).
+    The origin, (template ref, version, vertex index), is set on template
+    vertices by the search, and survives the splices of the working graph;
+    the edge counts are the context of the rh vertex in the working graph,
+    as its neighbors can be hier cells or primitives.  The least recently
+    used pairs are dropped beyond max_size.
+    """
+
+    def __init__(self, max_size=FAILURE_CACHE_SIZE):
+        self.max_size = max_size
+        self.failed = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __contains__(self, key):
+        if key in self.failed:
+            self.hits += 1
+            self.failed.move_to_end(key)
+            return True
+        self.misses += 1
+        return False
 
-                    tmp_map = compare_vertex(
-                        dict(mapping).update({edge_lh: edge_rh}),
-                        lh_design,
-                        lh_design.vs[edge_lh],
-                        rh_design,
-                        rh_design.vs[edge_rh],
-                    )
-
-                    if tmp_map:
-                        lh_edges.remove(edge_lh)
-                        possible_matches.append(edge_lh)
-                        possible_maps.append((edge_lh, edge_rh, tmp_map))
-                        mapping = possible_maps[0][2]
-                        break
+    def add(self, key):
+        self.failed[key] = None
+        if len(self.failed) > self.max_size:
+            self.failed.popitem(last=False)
+
+
+def undo_mapping(mapping, undo_log, mark):
+    """Remove the matches added to mapping since undo_log had length mark"""
+    while len(undo_log) > mark:
+        mapping.pop(undo_log.pop())
+
+
+def compare_edges(lh_adjacency, rh_adjacency, mapping, undo_log):
+    """
+    Match the neighbors of a matched vertex pair, group by group.
 
+    Generator used by compare_vertex: it yields each newly matched neighbor
+    pair (lh_idx, rh_idx) and is sent back whether the pair's own neighbors
+    matched.  Returns whether all edges matched.  When an edge group has
+    several candidates, the first one that matches is kept, and the
+    matches made while trying the others are undone.
+
+    lh/rh_adjacency (tuple)      - ("in", "out") adjacency of the matched
+                                 vertices, see GraphColumns.adjacency
+    mapping      (VertexMapping) - Current estimated matches of
+                                 verticies between the two graphs.
+                                 mapping[lh_vertex_idx] = rh_vertex_idx
+    undo_log     ([int])         - lh vertices in the order they were mapped
+    """
+    for rh_neighbors, lh_neighbors in create_edge_dict(lh_adjacency, rh_adjacency):
+        for rh_idx in rh_neighbors:
+            if not lh_neighbors:  # NO MATCHING EDGES
+                return False
+            elif len(lh_neighbors) == 1:  # ONLY ONE MATCHING EDGE
+                lh_idx = lh_neighbors[0]
+                if lh_idx in mapping:
+                    if mapping[lh_idx] != rh_idx:
+                        return False
                 else:
-                    if not possible_matches:
+                    if rh_idx in mapping.inverse:
                         return False
-                    elif len(possible_matches) == 1:
-                        mapping = possible_maps[0][2]
-                    else:
+                    mapping[lh_idx] = rh_idx
+                    undo_log.append(lh_idx)
+                    if not (yield lh_idx, rh_idx):
+                        return False
+                lh_neighbors.remove(lh_idx)
+            else:  # MULTIPLE MATCHING EDGES
+                for lh_idx in lh_neighbors:
+                    if lh_idx in mapping:
+                        if mapping[lh_idx] == rh_idx:
+                            break
+                    elif rh_idx not in mapping.inverse:
+                        mark = len(undo_log)
+                        mapping[lh_idx] = rh_idx
+                        undo_log.append(lh_idx)
                         # IF MULTIPLE MATCH, PICK THE FIRST ONE FOR NOW, MAY NEED A "SWAP PORTS" METHOD
-                        mapping = possible_maps[0][2]
-                        # TODO: If we always pick the first match why keep looking for matches?
-    return mapping
+                        if (yield lh_idx, rh_idx):
+                            break
+                        undo_mapping(mapping, undo_log, mark)
+                else:
+                    return False
+                lh_neighbors.remove(lh_idx)
+    return True
 
 
-def compare_vertex(mapping, lh_design, lh_vertex, rh_design, rh_vertex):
+def compare_vertex(
+    mapping, lh_design, lh_vertex, rh_design, rh_vertex, domains=None, failures=None
+):
     """
-    Recurisvely map vertices in two graphs, stemming from lh/rh vertex.
-
-    mapping      ({int: int})    - Current estimated matches of
+    Map vertices in two graphs, stemming from lh/rh vertex, which are
+    expected to be matched in mapping already.  Returns the extended mapping,
+    or False if the graphs do not match (mapping is left unchanged).  A
+    plain dict mapping is copied into a VertexMapping first.
+
+    The neighbors are compared depth first, as a recursive search would, but
+    with an explicit stack of compare_edges generators, so the stack depth
+    does not grow with the size of the matched region.  A single mapping is
+    updated in place, and failed candidates are rolled back with an undo log.
+    Vertex attributes are read from the column views of both graphs, see
+    get_columns.
+
+    mapping      (VertexMapping) - Current estimated matches of
                                  verticies between the two graphs.
                                  mapping[lh_vertex_idx] = rh_vertex_idx
     lh/rh_design (igraph.Graph)  - Graph of designs to compare.
     lh/rh_vertex (igraph.Vertex) - Verticies to stem comparison from.
+    domains      (dict)          - Optional candidate lh vertices of rh
+                                 vertices, see refine_domains.  rh vertices
+                                 without a domain may match any lh vertex.
+    failures     (FailureCache)  - Optional memory of the pairs that failed
+                                 on their own (refs, properties or edge
+                                 counts), checked before matching a pair.
     """
+    if not isinstance(mapping, VertexMapping):
+        mapping = VertexMapping(mapping)
+    undo_log = []
+
+    lh_columns, rh_columns = get_columns(lh_design), get_columns(rh_design)
+    lh_refs = lh_columns["ref"]
+
+    rh_origins = rh_columns["origin"]
 
-    if not compare_ref(lh_vertex, rh_vertex):
+    def visit(lh_idx, rh_idx):
+        if domains is not None and lh_idx not in domains.get(rh_idx, (lh_idx,)):
+            return False
+        rh_adjacency = rh_columns.adjacency(rh_design, rh_idx)
+        key = None
+        if failures is not None and rh_origins[rh_idx] is not None:
+            key = (lh_idx, rh_origins[rh_idx], edge_counts(rh_adjacency))
+            if key in failures:
+                return False
+        if not compare_ref_columns(lh_columns, lh_idx, rh_columns, rh_idx):
+            if key is not None:
+                failures.add(key)
+            return False
+        if lh_refs[lh_idx] in CONSTANT_REFS:
+            return True
+        lh_adjacency = lh_columns.adjacency(lh_design, lh_idx)
+        if not covers_edges(lh_adjacency, rh_adjacency):
+            if key is not None:
+                failures.add(key)
+            return False
+        return compare_edges(lh_adjacency, rh_adjacency, mapping, undo_log)
+
+    stack = []
+    result = visit(lh_vertex.index, rh_vertex.index)
+    if not isinstance(result, bool):
+        stack.append(result)
+        result = None
+    while stack:
+        try:
+            pair = stack[-1].send(result)
+        except StopIteration as stop:
+            stack.pop()
+            result = stop.value
+            continue
+        result = visit(*pair)
+        if not isinstance(result, bool):
+            stack.append(result)
+            result = None
+
+    if not result:
+        undo_mapping(mapping, undo_log, 0)
         return False
+    return mapping
 
-    if is_constant_vertex(lh_vertex):
-        return mapping
 
-    # Check in edges
-    if (
-        lh_vertex.attributes().get("input_vertex") is None
-        and rh_vertex.attributes().get("input_vertex") is None
-    ):
-        if not compare_edges(
-            lh_vertex.in_edges(), rh_vertex.in_edges(), mapping, lh_design, rh_design
-        ):
+class LadMatcher:
+    """
+    compare_vertex for a region of the rh design (see match_region) whose
+    vertices are all primitives, solved by igraph's LAD subisomorphism in C.
+
+    LAD does not compare edge colors, so both graphs are subdivided: every
+    non-port edge becomes a vertex between its two ends, and edge labels
+    are matched through the domains of those vertices, like vertex refs and
+    properties are matched through the (refined) domains of the vertices.
+    The target of a seed only holds the candidates within the radius of the
+    region around it, so a match costs the size of the seed's neighborhood,
+    not of the design.  Unlike the greedy compare_vertex, LAD backtracks
+    over every choice, so it can find a match compare_vertex misses, but any
+    match it finds meets the same conditions.
+    """
+
+    def __init__(self, lh_design, rh_design, region, domains):
+        self.lh_design = lh_design
+        self.region = region
+        self.region_domains = domains
+        self.radius = len(list(match_levels(rh_design, region[0]))) - 1
+        rh_columns = get_columns(rh_design)
+        rh_refs = rh_columns["ref"]
+        self.rh_position = rh_position = {x: i for i, x in enumerate(region)}
+
+        # Pattern: region vertices, then one vertex per edge between them
+        self.rh_edges = rh_edges = []
+        for x in region:
+            for label, neighbors in rh_columns.adjacency(rh_design, x)[1]:
+                for neighbor in neighbors:
+                    if neighbor not in rh_position:
+                        continue
+                    if rh_refs[x] in CONSTANT_REFS and rh_refs[neighbor] in CONSTANT_REFS:
+                        continue
+                    rh_edges.append((x, label, neighbor))
+        self.pattern = Graph(directed=True)
+        self.pattern.add_vertices(len(region) + len(rh_edges))
+        pattern_edges = []
+        for i, (source, _, target) in enumerate(rh_edges, len(region)):
+            pattern_edges += [(rh_position[source], i), (i, rh_position[target])]
+        self.pattern.add_edges(pattern_edges)
+
+    @staticmethod
+    def qualifies(rh_design, region):
+        """
+        Whether all vertices of a region are primitives, and some edge group
+        of a (non constant) region vertex has several neighbors.  Elsewhere
+        every rh edge is matched alone, and compare_vertex is exact.
+        """
+        columns = get_columns(rh_design)
+        primitive, refs = columns["IS_PRIMITIVE"], columns["ref"]
+        if not all(primitive[x] for x in region):
             return False
-    # Check out edges
-    if (
-        lh_vertex.attributes().get("output_vertex") is None
-        and rh_vertex.attributes().get("output_vertex") is None
-    ):
-        return compare_edges(
-            lh_vertex.out_edges(), rh_vertex.out_edges(), mapping, lh_design, rh_design
+        return any(
+            len(neighbors) > 1
+            for x in region
+            if refs[x] not in CONSTANT_REFS
+            for groups in columns.adjacency(rh_design, x)
+            for _, neighbors in groups
         )
-    return True
+
+    def target(self, lh_vertices):
+        """
+        Subdivided target graph of lh_vertices, with the domains of the
+        pattern vertices in it.
+        """
+        lh_columns = get_columns(self.lh_design)
+        lh_position = {x: i for i, x in enumerate(lh_vertices)}
+        domains = {x: [y for y in self.region_domains[x] if y in lh_position] for x in self.region}
+        lh_edges = {}
+        edge_domains = []
+        for source, label, target in self.rh_edges:
+            edge_domain = []
+            for lh_source in domains[source]:
+                groups = dict(lh_columns.adjacency(self.lh_design, lh_source)[1])
+                seen = {}
+                for lh_target in groups.get(label, ()):
+                    # Parallel edges with the same label are told apart by their count
+                    key = (lh_source, label, lh_target, seen.get(lh_target, 0))
+                    seen[lh_target] = key[3] + 1
+                    if lh_target not in lh_position or lh_target not in self.region_domains[target]:
+                        continue
+                    if key not in lh_edges:
+                        lh_edges[key] = len(lh_vertices) + len(lh_edges)
+                    edge_domain.append(lh_edges[key])
+            edge_domains.append(edge_domain)
+        target = Graph(directed=True)
+        target.add_vertices(len(lh_vertices) + len(lh_edges))
+        target_edges = []
+        for (lh_source, _, lh_target, _), i in lh_edges.items():
+            target_edges += [(lh_position[lh_source], i), (i, lh_position[lh_target])]
+        target.add_edges(target_edges)
+        vertex_domains = [sorted(lh_position[y] for y in domains[x]) for x in self.region]
+        return target, lh_position, vertex_domains + edge_domains
+
+    def match(self, lh_idx, rh_idx):
+        """
+        Match the region from lh_idx mapped to rh_idx, the first vertex of
+        the region.  Returns a VertexMapping of the region, or False if
+        there is no match.
+        """
+        if lh_idx not in self.region_domains[rh_idx]:
+            return False
+        # A region vertex n steps from rh_idx is matched n steps from lh_idx
+        lh_vertices = match_region(self.lh_design, lh_idx, self.radius)
+        target, lh_position, domains = self.target(lh_vertices)
+        domains[self.rh_position[rh_idx]] = [lh_position[lh_idx]]
+        found, mapping = target.subisomorphic_lad(
+            self.pattern, domains=domains, return_mapping=True
+        )
+        if not found:
+            return False
+        return VertexMapping((lh_vertices[mapping[i]], x) for i, x in enumerate(self.region))
+
+
+def compare_vertex_batch(lh_design, seeds, rh_design, rh_idx, domains=None, failures=None):
+    """
+    compare_vertex of every lh vertex of seeds against rh vertex rh_idx,
+    advanced in lockstep.  Returns the mapping (or False) of every seed.
+
+    All seeds walk the same rh edges in the same order, a plan made once
+    from match_region.  While every edge group of an lh vertex has a single
+    neighbor, like its rh vertex, the match is forced, so the seeds are
+    moved along the plan together: each step extends the mapping of every
+    live seed by one edge, and seeds that fail it are dropped.  A seed that
+    meets an edge group with several lh neighbors is handed to
+    compare_vertex, which resolves the choice.  An rh group with several
+    neighbors is left out of the plan, along with the edges of the vertices
+    only it reaches, and the seeds that pass the rest of the plan are then
+    handed to compare_vertex.
+    """
+    lh_columns, rh_columns = get_columns(lh_design), get_columns(rh_design)
+    rh_refs = rh_columns["ref"]
+    region = match_region(rh_design, rh_idx)
+    position = {x: i for i, x in enumerate(region)}
+
+    def scalar(lh_idx):
+        lh_vertex, rh_vertex = lh_design.vs[lh_idx], rh_design.vs[rh_idx]
+        return compare_vertex(
+            {lh_idx: rh_idx}, lh_design, lh_vertex, rh_design, rh_vertex, domains, failures
+        )
+
+    # Plan: (source, mode, label, target, whether target is first reached)
+    plan = []
+    reached = {0}
+    ambiguous = False
+    for x in region:
+        if rh_refs[x] in CONSTANT_REFS or position[x] not in reached:
+            # Left unreached only behind an ambiguous group
+            continue
+        for mode, groups in enumerate(rh_columns.adjacency(rh_design, x)):
+            for label, neighbors in groups:
+                if len(neighbors) != 1:
+                    ambiguous = True
+                    continue
+                target = position[neighbors[0]]
+                plan.append((position[x], mode, label, target, target not in reached))
+                reached.add(target)
+
+    def admits(lh_idx, target):
+        domain = domains.get(region[target]) if domains is not None else None
+        if domain is not None and lh_idx not in domain:
+            return False
+        return compare_ref_columns(lh_columns, lh_idx, rh_columns, region[target])
+
+    results = [False] * len(seeds)
+    assigned = [[None] * len(seeds) for _ in region]
+    used = [None] * len(seeds)
+    live = []
+    for s, lh_idx in enumerate(seeds):
+        if admits(lh_idx, 0):
+            assigned[0][s] = lh_idx
+            used[s] = {lh_idx}
+            live.append(s)
+    lh_groups = {}
+    for source, mode, label, target, first in plan:
+        step = []
+        for s in live:
+            lh_source = assigned[source][s]
+            groups = lh_groups.get(lh_source)
+            if groups is None:
+                adjacency = lh_columns.adjacency(lh_design, lh_source)
+                groups = lh_groups[lh_source] = [dict(x) for x in adjacency]
+            neighbors = groups[mode].get(label, ())
+            if len(neighbors) != 1:
+                if neighbors:
+                    results[s] = scalar(seeds[s])
+                continue
+            lh_target = neighbors[0]
+            if first:
+                if lh_target in used[s] or not admits(lh_target, target):
+                    continue
+                assigned[target][s] = lh_target
+                used[s].add(lh_target)
+            elif assigned[target][s] != lh_target:
+                continue
+            step.append(s)
+        live = step
+
+    for s in live:
+        if ambiguous:
+            results[s] = scalar(seeds[s])
+        else:
+            results[s] = VertexMapping((assigned[i][s], x) for i, x in enumerate(region))
+    return results
@@ -9,4 +9,5 @@ CHECKPT_DIR = ROOT_PATH / "checkpoints"
 RES_DIR = ROOT_PATH / "results"
 RECORD_CORE_TCL = ROOT_PATH / "src" / "core.tcl"
 CORE_FUZZER_TCL = ROOT_PATH / "src" / "core_fuzzer.tcl"
+VIVADO = "vivado"
 TEST_RESOURCES = ROOT_PATH / "test_resources"
@@ -22,13 +22,51 @@ Create graph library of hierarchal ip.
 import argparse
 import json
 import shutil
+import sys
+from collections import Counter
 from itertools import cycle
 from pathlib import Path
 from subprocess import Popen, PIPE
 from igraph import Graph
 
-from compare_v_refactor import compare_eqn, import_design, print_graph
+from compare_v_refactor import (
+    CONSTANT_REFS,
+    compare_eqn,
+    import_design,
+    index_edges,
+    match_region,
+    print_graph,
+)
 from config import RECORD_CORE_TCL, ROOT_PATH
+from packed_lib import PACKED_LIB_NAME, pack_graph, write_packed_library
+
+# Template attributes read by the search, kept in the search projection
+SEARCH_VERTEX_ATTRS = [
+    "id",
+    "name",
+    "ref",
+    "IS_PRIMITIVE",
+    "color",
+    "CONFIG.EQN",
+    "EQN_PIN_DICT",
+    "BEL_PROPERTIES",
+    "input_vertex",
+    "output_vertex",
+    "PARAM_PROPERTIES",
+    "PARAM_EQN",
+]
+SEARCH_EDGE_ATTRS = ["in_pin", "out_pin", "signal"]
+
+
+def intern_strings(value):
+    """Interns every string within value so repeated strings are stored once"""
+    if isinstance(value, str):
+        return sys.intern(value)
+    if isinstance(value, dict):
+        return {intern_strings(k): intern_strings(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [intern_strings(x) for x in value]
+    return value
 
 
 class LibraryGenerator:
@@ -65,42 +103,69 @@ class LibraryGenerator:
         self.create_submodules()
         self.init_templates()
 
-    def get_module_subgraph(self, graph_obj, parent):
+    def index_design(self, graph_obj):
+        """
+        Groups the cells and nets of a design by parent in a single pass,
+        along with the attribute columns needed to extract each hierarchical
+        cell without scanning the whole design again.
+        """
+        cells = {}
+        for i, parent in enumerate(graph_obj.vs["parent"]):
+            cells.setdefault(parent, []).append(i)
+        nets = {}
+        for i, parent in enumerate(graph_obj.es["parent"]):
+            nets.setdefault(parent, []).append(i)
+        return {
+            "names": {name: i for i, name in enumerate(graph_obj.vs["name"])},
+            "cells": cells,
+            "nets": nets,
+            "edges": graph_obj.get_edgelist(),
+            "vertex_attrs": {x: graph_obj.vs[x] for x in graph_obj.vs.attributes()},
+            "edge_attrs": {x: graph_obj.es[x] for x in graph_obj.es.attributes()},
+        }
+
+    def get_module_subgraph(self, graph_obj, parent, design_index=None):
         """
         Returns an iGraph of just the signal hierarchical cell (all
         cells that have the same parent).
         """
-        parents = graph_obj.vs.select(name=parent)
-        g = Graph(directed=True)
-        if len(parents) == 0:
+        if design_index is None:
+            design_index = self.index_design(graph_obj)
+        if parent not in design_index["names"]:
             return None
-        g.add_vertices(1, parents[0].attributes())
-        v_dict = {parents[0].index: 0}
-        v_list = [parents[0].index]
-        g.vs[0]["name"] = g.vs[0]["name"].split("/")[-1]
-        i = 1
-
-        for v in graph_obj.vs.select(parent=parent):
-            v_list.append(v.index)
-            v_dict[v.index] = i
-            g.add_vertices(1, v.attributes())
-            g.vs[i]["name"] = g.vs[i]["name"].split("/")[-1]
-            g.vs[i]["parent"] = g.vs[i]["parent"].split("/")[-1]
-            i += 1
-
-        for i, e in enumerate(graph_obj.es.select(parent=parent)):
-            if e.source not in v_dict:
-                print("MISSING:", e.source, e.target, graph_obj.vs[e.source]["name"])
-            elif e.target not in v_dict:
-                print("MISSING:", e.source, e.target, graph_obj.vs[e.target]["name"])
-            else:
-                g.add_edges([(v_dict[e.source], v_dict[e.target])], e.attributes())
-                g.es[i]["parent"] = g.es[i]["parent"].split("/")[-1]
 
-        for v in g.vs:
-            v["id"] = v.index
-
-        return g
+        v_list = [design_index["names"][parent]] + design_index["cells"].get(parent, [])
+        v_dict = {v: i for i, v in enumerate(v_list)}
+        e_list = []
+        edges = []
+        for e in design_index["nets"].get(parent, []):
+            source, target = design_index["edges"][e]
+            if source not in v_dict:
+                print("MISSING:", source, target, design_index["vertex_attrs"]["name"][source])
+            elif target not in v_dict:
+                print("MISSING:", source, target, design_index["vertex_attrs"]["name"][target])
+            else:
+                e_list.append(e)
+                edges.append((v_dict[source], v_dict[target]))
+
+        vertex_attrs = {
+            x: [column[v] for v in v_list] for x, column in design_index["vertex_attrs"].items()
+        }
+        vertex_attrs["name"] = [x.split("/")[-1] for x in vertex_attrs["name"]]
+        vertex_attrs["parent"][1:] = [x.split("/")[-1] for x in vertex_attrs["parent"][1:]]
+        vertex_attrs["id"] = list(range(len(v_list)))
+        edge_attrs = {
+            x: [column[e] for e in e_list] for x, column in design_index["edge_attrs"].items()
+        }
+        edge_attrs["parent"] = [x.split("/")[-1] for x in edge_attrs["parent"]]
+
+        return Graph(
+            n=len(v_list),
+            edges=edges,
+            directed=True,
+            vertex_attrs=vertex_attrs,
+            edge_attrs=edge_attrs,
+        )
 
     def get_user_properties(self, g):
         """Gets the User Properties of the Hierarchical Cell"""
@@ -207,9 +272,10 @@ class LibraryGenerator:
     def create_templates(self, g, templates):
         """Main function for creating all hierarchical cells from a design"""
         has_new_data = 0
+        design_index = self.index_design(g)
+        user_properties = self.get_user_properties(g)
         for v in g.vs.select(IS_PRIMITIVE=False):
-            g_sub = self.get_module_subgraph(g, v["name"])
-            user_properties = self.get_user_properties(g)
+            g_sub = self.get_module_subgraph(g, v["name"], design_index)
             g_sub["user_properties"] = user_properties
             if v["ref"] not in templates:
                 (self.templ_dir / v["ref"]).mkdir(exist_ok=True)
@@ -262,19 +328,23 @@ class LibraryGenerator:
 
     def init_templates(self):
         """
-        Parses library folder and creates dictionary of all templates.
+        Parses library folder and creates dictionary of all templates, both
+        as the templates.json summary and as the packed library read by the
+        search.
         """
         templates = {}
+        packed = {}
         used_list = {}
         for cell in self.templ_dir.iterdir():
             if cell.is_dir():
                 templates[cell.name] = {}
+                packed[cell.name] = {}
                 for y in cell.iterdir():
                     x = cell.name
                     y = y.name
                     templates[x][y] = {}
                     templates[x][y]["file"] = f"library/{self.ip}/templates/{x}/{y}"
-                    g_template = Graph.Read_Pickle(templates[x][y]["file"])
+                    g_template = Graph.Read_Pickle(str(self.templ_dir / x / y))
                     for template in g_template.vs.select(IS_PRIMITIVE=False, id_ne=0):
                         if template["ref"] not in used_list:
                             used_list[template["ref"]] = [x]
@@ -289,6 +359,7 @@ class LibraryGenerator:
                         span_dict.append(tmp_dict)
                     templates[x][y]["span"] = span_dict
                     templates[x][y]["primitive_count"] = g_template["primitive_count"]
+                    packed[x][y] = g_template
         for x in used_list:
             used_list[x] = list(set(used_list[x]))
         output = self.lib_dir / "templates.json"
@@ -296,6 +367,163 @@ class LibraryGenerator:
             tmp = {"templates": templates, "used": used_list}
             json.dump(tmp, f, indent=2, sort_keys=True)
 
+        library_histogram = Counter()
+        for x in packed:
+            for y, g_template in packed[x].items():
+                library_histogram.update(g_template.vs["ref"][1:])
+        for x in packed:
+            folded = self.fold_parametric_versions(packed[x])
+            packed[x] = {y: packed[x][y] for y in folded}
+            for y, g_template in packed[x].items():
+                search_data = self.get_search_metadata(g_template)
+                projection = self.get_search_projection(g_template)
+                packed[x][y] = {
+                    "members": folded[y],
+                    "span": self.get_span_anchors(
+                        templates[x][y]["span"], projection, search_data, library_histogram
+                    ),
+                    "primitive_count": g_template["primitive_count"],
+                    "ports": search_data["ports"],
+                    "blobs": {
+                        "graph": pack_graph(g_template),
+                        "projection": pack_graph(projection),
+                    },
+                }
+        write_packed_library(self.lib_dir / PACKED_LIB_NAME, packed, used_list)
+
+    def get_structure_key(self, g):
+        """
+        Hashable description of the cells and connectivity of a template, with
+        the BEL property names (not values) of every cell.  As in
+        compare_templates, the instance name of the top cell is ignored.
+        """
+        return (
+            tuple(zip(g.vs["name"][1:], g.vs["ref"][1:])),
+            tuple(tuple(sorted(x or ())) for x in g.vs["BEL_PROPERTIES"][1:]),
+            tuple(sorted(zip(g.get_edgelist(), g.es["in_pin"], g.es["out_pin"], g.es["signal"]))),
+        )
+
+    def fold_parametric_versions(self, versions):
+        """
+        Folds the versions of a hierarchical cell that share the same cells
+        and connectivity, and only differ in BEL property values, into the
+        first of them.  Versions where a cell has a property the same cell of
+        another lacks are kept apart: the first version's value would
+        otherwise be required of every design cell with the property.
+        Returns the member versions of every kept version.
+        """
+        groups = {}
+        for ver in sorted(versions):
+            groups.setdefault(self.get_structure_key(versions[ver]), []).append(ver)
+        folded = {}
+        for members in groups.values():
+            if len(members) > 1:
+                self.add_parametric_properties(versions[members[0]], [versions[x] for x in members])
+            folded[members[0]] = members
+        return folded
+
+    def add_parametric_properties(self, g, graphs):
+        """
+        Stores on g the values allowed for every BEL property that varies
+        across graphs (PARAM_PROPERTIES), the allowed lut equations
+        (PARAM_EQN) and the user properties of all of them.
+        """
+        param_properties = []
+        param_eqn = []
+        for i, v in enumerate(g.vs):
+            if not v["IS_PRIMITIVE"]:
+                param_properties.append(None)
+                param_eqn.append(None)
+                continue
+            values = {}
+            eqns = []
+            for g_member in graphs:
+                v_member = g_member.vs[i]
+                for prop, value in v_member["BEL_PROPERTIES"].items():
+                    values.setdefault(prop, set()).add(value)
+                eqn = {x: v_member[x] for x in ("CONFIG.EQN", "EQN_PIN_DICT")}
+                if eqn not in eqns:
+                    eqns.append(eqn)
+            varying = {prop: sorted(x) for prop, x in values.items() if len(x) > 1}
+            param_properties.append(varying if varying else None)
+            param_eqn.append(eqns if len(eqns) > 1 else None)
+        g.vs["PARAM_PROPERTIES"] = param_properties
+        g.vs["PARAM_EQN"] = param_eqn
+
+        for g_member in graphs[1:]:
+            for prop, values in g_member["user_properties"].items():
+                for value in values:
+                    if value not in g["user_properties"].setdefault(prop, []):
+                        g["user_properties"][prop].append(value)
+
+    def get_search_projection(self, g):
+        """
+        Copy of a template with only the attributes read by the search.  The
+        specimen recording data (cell properties, labels, parents, net names,
+        ports and user properties) is dropped.
+        """
+        vertex_attrs = {
+            x: intern_strings(g.vs[x]) for x in SEARCH_VERTEX_ATTRS if x in g.vs.attributes()
+        }
+        edge_attrs = {
+            x: intern_strings(g.es[x]) for x in SEARCH_EDGE_ATTRS if x in g.es.attributes()
+        }
+        return Graph(
+            n=g.vcount(),
+            edges=g.get_edgelist(),
+            directed=True,
+            vertex_attrs=vertex_attrs,
+            edge_attrs=edge_attrs,
+        )
+
+    def get_search_metadata(self, g):
+        """
+        Data used to seed the search: the degree of every vertex over
+        non-port edges, which picks the span anchors, and the boundary ports
+        of the top cell, which port_pre_check reads.
+        """
+        degree = [[0, 0] for _ in g.vs]
+        top_in, top_out = [], []
+        for (source, target), in_pin, out_pin, signal in zip(
+            g.get_edgelist(), g.es["in_pin"], g.es["out_pin"], g.es["signal"]
+        ):
+            if source == 0:
+                top_in.append(out_pin)
+            if target == 0:
+                top_out.append(in_pin)
+            if signal != "port":
+                degree[target][0] += 1
+                degree[source][1] += 1
+        return {"degree": degree, "ports": {"in": sorted(top_in), "out": sorted(top_out)}}
+
+    def get_span_anchors(self, spans, g, search_data, library_histogram):
+        """
+        Picks the anchor of every span: the vertex whose ref is rarest in the
+        library, preferring the most connected vertex among equally rare refs.
+        Also counts the refs of the non-constant vertices compare_vertex maps
+        from the anchor (see match_region), which a design must have at least
+        as many of for the span to match anywhere in it.
+        """
+        # Indexed copy, the template itself is packed as it is
+        g = g.copy()
+        index_edges(g)
+        refs = g.vs["ref"]
+        degree = search_data["degree"]
+        anchored = []
+        for span in spans:
+            span = dict(span)
+            span["anchor"] = min(
+                span["indices"],
+                key=lambda x: (library_histogram[refs[x]], -sum(degree[x])),
+            )
+            span["ref_histogram"] = dict(
+                Counter(
+                    refs[x] for x in match_region(g, span["anchor"]) if refs[x] not in CONSTANT_REFS
+                )
+            )
+            anchored.append(span)
+        return anchored
+
     def print_graph_version(self, cell, version, graph_obj):
         with open(self.graphs_dir / cell / f"{version}.txt", "w") as f:
             print_graph(graph_obj, f)
@@ -0,0 +1,166 @@
+# Copyright 2020-2022 IPRec Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# SPDX-License-Identifier: Apache-2.0
+
+"""
+Single file template library.
+
+A packed library holds every template of an IP in one file.  The file
+starts with a fixed header and a json index of the refs, versions,
+spans, primitive counts and the used-by map.  The serialized template
+graphs follow the index, and each version records the offset and length
+of its blobs so they can be decoded lazily from a memory map.
+
+Layout:
+    header  - magic, format version, index length
+    index   - json {"templates": {ref: {ver: {..., "blobs": {kind: [offset, length]}}}},
+                    "used": {ref: [refs]}}
+    data    - blobs, offsets are relative to the end of the index
+"""
+
+from array import array
+import json
+import mmap
+import pickle
+import struct
+import zlib
+from pathlib import Path
+from igraph import Graph
+
+
+PACKED_LIB_NAME = "templates.lib"
+MAGIC = b"IPRECLIB"
+FORMAT_VERSION = 1
+HEADER = struct.Struct("<8sIQ")
+
+
+def pack_object(obj):
+    """Serialize a python object into a compressed blob"""
+    return zlib.compress(pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL))
+
+
+def unpack_object(blob):
+    return pickle.loads(zlib.decompress(blob))
+
+
+def pack_graph(g):
+    """Serialize an iGraph as attribute columns and a flat edge array"""
+    edges = array("I")
+    for edge in g.get_edgelist():
+        edges.extend(edge)
+    return pack_object(
+        {
+            "n": g.vcount(),
+            "edges": edges,
+            "graph_attrs": {x: g[x] for x in g.attributes()},
+            "vertex_attrs": {x: g.vs[x] for x in g.vs.attributes()},
+            "edge_attrs": {x: g.es[x] for x in g.es.attributes()},
+        }
+    )
+
+
+def unpack_graph(blob):
+    """Rebuild an iGraph from the output of pack_graph"""
+    data = unpack_object(blob)
+    edges = data["edges"]
+    return Graph(
+        n=data["n"],
+        edges=list(zip(edges[0::2], edges[1::2])),
+        directed=True,
+        graph_attrs=data["graph_attrs"],
+        vertex_attrs=data["vertex_attrs"],
+        edge_attrs=data["edge_attrs"],
+    )
+
+
+def write_packed_library(path, templates, used):
+    """
+    Write a packed library.
+
+    templates ({ref: {ver: dict}}) - index entry of every template version,
+                                     with the serialized blobs of the version
+                                     under "blobs" ({kind: bytes}).
+    used      ({ref: [ref]})       - refs of the templates that use each ref.
+    """
+    index = {}
+    blobs = []
+    offset = 0
+    for ref, versions in templates.items():
+        index[ref] = {}
+        for ver, entry in versions.items():
+            index[ref][ver] = dict(entry)
+            index[ref][ver]["blobs"] = {}
+            for kind, blob in entry["blobs"].items():
+                index[ref][ver]["blobs"][kind] = [offset, len(blob)]
+                blobs.append(blob)
+                offset += len(blob)
+
+    index_data = json.dumps({"templates": index, "used": used}, sort_keys=True).encode()
+    with open(path, "wb") as f:
+        f.write(HEADER.pack(MAGIC, FORMAT_VERSION, len(index_data)))
+        f.write(index_data)
+        for blob in blobs:
+            f.write(blob)
+
+
+class PackedLibrary:
+    """
+    Read-only view of a packed library.  Only the index is parsed when the
+    library is opened; template graphs are decoded on request.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.open()
+
+    def open(self):
+        with open(self.path, "rb") as f:
+            magic, version, index_length = HEADER.unpack(f.read(HEADER.size))
+            if magic != MAGIC:
+                raise ValueError(f"{self.path} is not a packed template library")
+            if version != FORMAT_VERSION:
+                raise ValueError(f"{self.path} has unsupported format version {version}")
+            index = json.loads(f.read(index_length))
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.templates = index["templates"]
+        self.used = index["used"]
+        self.data_start = HEADER.size + index_length
+
+    def close(self):
+        self.data.close()
+
+    def blob(self, ref, ver, kind="graph"):
+        """Raw bytes of one blob of a template version"""
+        offset, length = self.templates[ref][ver]["blobs"][kind]
+        start = self.data_start + offset
+        return self.data[start : start + length]
+
+    def load(self, ref, ver, kind="graph"):
+        """Decode a template graph"""
+        return unpack_graph(self.blob(ref, ver, kind))
+
+    def __getstate__(self):
+        # Memory maps cannot be pickled; processes reopen the file instead
+        return {"path": self.path}
+
+    def __setstate__(self, state):
+        self.path = state["path"]
+        self.open()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
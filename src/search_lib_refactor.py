@@ -22,6 +22,8 @@ searches for the IP core within the design
 """
 
 import argparse
+from collections import OrderedDict
+from contextlib import contextmanager
 from igraph import Graph
 import json
 from multiprocessing import Pool
@@ -31,11 +33,274 @@ from subprocess import Popen, STDOUT, PIPE
 import sys
 
 
-from compare_v import compare_vertex, import_design
+from compare_v_refactor import (
+    COLUMN_ATTRS,
+    CONSTANT_REFS,
+    FailureCache,
+    LadMatcher,
+    SignatureIndex,
+    VertexMapping,
+    compare_ref_columns,
+    compare_vertex,
+    compare_vertex_batch,
+    copy_columns,
+    extend_columns,
+    get_columns,
+    import_design,
+    index_edges,
+    match_levels,
+    match_region,
+    refine_domains,
+    set_vertex_attr,
+    truncate_columns,
+)
 from config import LIB_DIR, VIVADO, CHECKPT_DIR, RECORD_CORE_TCL
+from packed_lib import PACKED_LIB_NAME, PackedLibrary
 
 
 GREEDY = True
+# Seed find_template from design vertices inside matches it already found
+FIND_OVERLAPPING = False
+# Match primitive-only spans with igraph's LAD subisomorphism, see LadMatcher
+# (off: compare_vertex_batch is faster on the spans seen so far)
+LAD_BACKEND = False
+# Seeds find_template hands compare_vertex_batch at once, between which the
+# seeds inside new matches are dropped
+SEED_BATCH_SIZE = 64
+WORKERS = 8
+# Mappings of recent search states kept by every descend worker, see SearchState
+WORKER_STATES = 4
+# Vertices plus edges of the decoded templates kept by TemplateCache
+TEMPLATE_CACHE_SIZE = 1000000
+# Edge attributes carried over to rewired port edges when the template has them
+EDGE_NAME_ATTRS = {"parent", "name"}
+# Vertex attributes written by index_edges, which are not copied with the vertices
+ADJACENCY_ATTRS = {"in_adj", "out_adj"}
+# Vertex attributes seed_filter checks, compared by anchor_key (the "origin" tag is per vertex)
+STRUCTURE_ATTRS = tuple(x for x in COLUMN_ATTRS if x not in ADJACENCY_ATTRS and x != "origin")
+
+
+def freeze(value):
+    """Hashable copy of nested dicts, lists and tuples, dicts in key order"""
+    if isinstance(value, dict):
+        return tuple(sorted((k, freeze(x)) for k, x in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(x) for x in value)
+    return value
+
+
+# State of a descend worker process, set up once by init_worker
+_worker = {}
+
+
+def init_worker(searcher, g):
+    """Pool initializer, keeps the design graph and the template library in the worker"""
+    _worker["search"] = searcher
+    _worker["g"] = g
+    get_columns(g)
+    _worker["ops"] = None
+    _worker["g_template"] = None
+    _worker["states"] = OrderedDict()
+
+
+def descend_task(task):
+    """
+    Try one template version on a hier cell of the working graph in a worker
+    process.  The working graph is rebuilt from its operation log, and kept
+    for the next task of the same search step.  Returns None when the mapping
+    was sent as changes to a state this worker does not have.
+    """
+    state, ref, ver, v_id = task
+    searcher = _worker["search"]
+    states = _worker["states"]
+    mapping = state.resolve(states)
+    if mapping is None:
+        return None
+    states[state.key] = mapping
+    states.move_to_end(state.key)
+    while len(states) > WORKER_STATES:
+        states.popitem(last=False)
+    if _worker["ops"] != state.ops:
+        _worker["g_template"] = searcher.rebuild_template(
+            state.ops, _worker["ops"], _worker["g_template"]
+        )
+        _worker["ops"] = state.ops
+    return searcher.try_descend(_worker["g"], _worker["g_template"], mapping, ref, ver, v_id)
+
+
+class TemplateCache:
+    """
+    Bounded LRU cache of decoded template graphs.  The size of a template
+    is its vertex plus edge count, and the least recently used templates
+    are evicted once the total exceeds max_size.  Callers get copies, so the
+    cached graphs are never modified.  igraph copies attribute values by
+    reference, so the values (e.g. the BEL_PROPERTIES dicts) are shared with
+    the cache and must be treated as read-only: attributes are replaced,
+    never edited in place.
+    """
+
+    def __init__(self, load, max_size=TEMPLATE_CACHE_SIZE):
+        self.load = load
+        self.max_size = max_size
+        self.graphs = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, *key):
+        g = self.graphs.get(key)
+        if g is None:
+            self.misses += 1
+            g = self.load(*key)
+            self.graphs[key] = g
+            self.size += g.vcount() + g.ecount()
+            while self.size > self.max_size and len(self.graphs) > 1:
+                _, g_old = self.graphs.popitem(last=False)
+                self.size -= g_old.vcount() + g_old.ecount()
+        else:
+            self.hits += 1
+            self.graphs.move_to_end(key)
+        return g.copy()
+
+
+class GraphOverlay:
+    """
+    Trial edit of a working graph, made in place.  Vertices and edges are only
+    appended, attribute changes of existing vertices are recorded, and edges
+    of existing vertices are only deleted on commit.  Rolling back deletes the
+    appended vertices (with their edges) and restores the recorded values,
+    which gives back the original graph, vertex and edge order included.
+    """
+
+    def __init__(self, g):
+        self.g = g
+        self.vcount = g.vcount()
+        self.ecount = g.ecount()
+        self.graph_attrs = {x: g[x] for x in g.attributes()}
+        self.vertex_attrs = {}
+        self.deleted_es = []
+
+    def set_vertex(self, v_id, attr, value):
+        if v_id < self.vcount and (v_id, attr) not in self.vertex_attrs:
+            self.vertex_attrs[(v_id, attr)] = self.g.vs[v_id][attr]
+        set_vertex_attr(self.g, v_id, attr, value)
+
+    def delete_edges(self, es):
+        """Deletes appended edges now and defers the rest to commit"""
+        es = [x.index if not isinstance(x, int) else x for x in es]
+        self.deleted_es += [x for x in es if x < self.ecount]
+        self.g.delete_edges([x for x in es if x >= self.ecount])
+
+    def rollback(self):
+        self.g.delete_vertices(range(self.vcount, self.g.vcount()))
+        truncate_columns(self.g)
+        for (v_id, attr), value in self.vertex_attrs.items():
+            set_vertex_attr(self.g, v_id, attr, value)
+        for attr in self.g.attributes():
+            if attr not in self.graph_attrs:
+                del self.g[attr]
+        for attr, value in self.graph_attrs.items():
+            self.g[attr] = value
+        return self.g
+
+    def commit(self, copy=False):
+        """
+        Applies the edit and returns the edited graph.  With copy, the edit is
+        applied to a copy and the original graph is rolled back.
+        """
+        g = self.g.copy() if copy else self.g
+        g.delete_edges(self.deleted_es)
+        if copy:
+            copy_columns(self.g, g)
+            self.rollback()
+        return g
+
+
+class SearchState:
+    """
+    Working graph and mapping shared by the descend tasks of a search step.
+
+    The graph travels as its operation log, which workers replay from their
+    own copy of the library.  Given base, the (key, mapping) of a state sent
+    before, the mapping travels as its changes to that state, which workers
+    keep the last WORKER_STATES of.  Tasks of a chunk reference the same
+    state, so it is pickled once per chunk.
+    """
+
+    def __init__(self, g_template, mapping, key=None, base=None):
+        ops = g_template["ops"] if "ops" in g_template.attributes() else None
+        if ops is None:
+            raise ValueError("Working graph has no operation log, see start_template")
+        self.ops = ops
+        self.key = key
+        if base is None:
+            self.base_key = None
+            self.mapping = mapping
+            return
+        self.base_key, base_mapping = base
+        self.mapping = None
+        self.changed = {
+            x: y for x, y in mapping.items() if x not in base_mapping or base_mapping[x] != y
+        }
+        self.removed = [x for x in base_mapping if x not in mapping]
+
+    def resolve(self, states):
+        """The mapping, or None if it was sent as changes to a state not in states"""
+        if self.mapping is not None:
+            return self.mapping
+        base_mapping = states.get(self.base_key)
+        if base_mapping is None:
+            return None
+        mapping = base_mapping.copy()
+        # Unmap the changed keys first, so no value is briefly mapped twice
+        for x in self.removed:
+            del mapping[x]
+        for x in self.changed:
+            mapping.pop(x, None)
+        mapping.update(self.changed)
+        return mapping
+
+
+class Frontier:
+    """
+    Hier cells of a working graph next to a set of base vertices, as found by
+    get_spanning_hier_cells, kept up to date as hier cells are descended into.
+
+    A descend only changes the edges of the replaced cell, of its neighbors
+    and of the spliced vertices, so replace looks at those alone and the
+    cost of an update is the size of the change.  Vertex indices survive a
+    descend; an ascend renumbers the graph and needs a new Frontier.
+    """
+
+    def __init__(self, g, base):
+        self.base = set(base)
+        self.cells = set()
+        self.add(g, self.base)
+
+    def add(self, g, vertices):
+        """Add vertices to the base and their hier neighbors to the cells"""
+        self.base.update(vertices)
+        colors = get_columns(g)["color"]
+        for v_id in vertices:
+            self.cells.update(x for x in g.neighbors(v_id) if colors[x] == "green")
+
+    def replace(self, g, v_hier_id, neighbors, vertices):
+        """
+        Update for hier cell v_hier_id, which had neighbors, replaced in g by
+        its template, with vertices as the new base vertices.
+        """
+        self.cells.discard(v_hier_id)
+        self.add(g, vertices)
+        for v_id in neighbors:
+            if v_id in self.base:
+                # Rewired to the spliced vertices, which can be hier cells
+                self.add(g, (v_id,))
+            if v_id in self.cells and not self.base.intersection(g.neighbors(v_id)):
+                self.cells.discard(v_id)
+
+    def hier_cells(self, g):
+        colors = get_columns(g)["color"]
+        return sorted(x for x in self.cells if x != 0 and colors[x] == "green")
 
 
 class IP_Search:
@@ -55,8 +320,16 @@ class IP_Search:
         checkpoint (int) the point to resume search.
         force_gen (bool) force regeneration of pickle file
         """
-        self.mapped_list = []
-        self.descend_failed_dict = {}
+        self.pool = None
+        # Key and mapping of the last SearchState sent to the workers
+        self.sent_state = None
+        self.seeds = None
+        self.signatures = None
+        self.library_seeds = None
+        # Smallest candidate domain of every span searched, see span_domains
+        self.domain_sizes = {}
+        # Matchers of every span searched, "python", or "lad" when LAD retries its misses
+        self.span_backends = {}
 
         if design.suffix == ".dcp":
             self.import_dcp(design)
@@ -77,10 +350,15 @@ class IP_Search:
         else:
             g = Graph.Read_Pickle(str(pickle_f))
 
-        with open(LIB_DIR / IP / "templates.json", "r") as f:
-            tmp = json.load(f)
-            self.templates = tmp["templates"]
-            self.used_list = tmp["used"]
+        self.library = PackedLibrary(LIB_DIR / IP / PACKED_LIB_NAME)
+        self.templates = self.library.templates
+        self.used_list = self.library.used
+        self.template_cache = TemplateCache(self.decode_template)
+        self.failure_cache = FailureCache()
+        # Template versions that failed to descend, see descend_context
+        self.descend_failures = FailureCache()
+        # Reach of a descend by hier cell ref, see descend_radius
+        self.descend_radii = {}
 
         # Either search, or start from a known checkpoint
         if not checkpoint:
@@ -96,6 +374,114 @@ class IP_Search:
             self.print_all_cells(g, g_template, template_mapping)
         else:
             print("NO FOUND TEMPLATES")
+        print(
+            "TEMPLATE CACHE HITS:",
+            self.template_cache.hits,
+            "MISSES:",
+            self.template_cache.misses,
+        )
+        print(
+            "SPANS SEARCHED:",
+            len(self.domain_sizes),
+            "SKIPPED (EMPTY DOMAINS):",
+            sum(1 for x in self.domain_sizes.values() if not x),
+        )
+        print(
+            "FAILURE CACHE HITS:",
+            self.failure_cache.hits,
+            "MISSES:",
+            self.failure_cache.misses,
+        )
+        print(
+            "DESCEND FAILURE HITS:",
+            self.descend_failures.hits,
+            "MISSES:",
+            self.descend_failures.misses,
+        )
+        backends = list(self.span_backends.values())
+        print("SPANS MATCHED BY LAD:", backends.count("lad"), "PYTHON:", backends.count("python"))
+
+    def load_template(self, ref, ver, full=False):
+        """
+        Loads the search projection of a template, or the complete template
+        as recorded from the specimens when full is set (for reporting).
+        """
+        blobs = self.templates[ref][ver]["blobs"]
+        kind = "graph" if full or "projection" not in blobs else "projection"
+        return self.template_cache.get(ref, ver, kind)
+
+    def __getstate__(self):
+        # Workers get their own copy of the search, without the pool
+        state = dict(self.__dict__)
+        state["pool"] = None
+        state["sent_state"] = None
+        state["seeds"] = None
+        state["signatures"] = None
+        state["library_seeds"] = None
+        return state
+
+    @contextmanager
+    def worker_pool(self, g):
+        """Start the descend workers for a search of design g"""
+        with Pool(processes=WORKERS, initializer=init_worker, initargs=(self, g)) as self.pool:
+            try:
+                yield self.pool
+            finally:
+                self.pool = None
+                self.sent_state = None
+
+    def apply_template(self, g, ref, ver, v1_id, direction, overlay=None, g_hier=None):
+        """
+        replace_hier_cell with a template version from the library, or with
+        g_hier if the caller loaded it already.  Successful replacements are
+        appended to the operation log of g ("ops"), from which the working
+        graph can be rebuilt by rebuild_template.
+        """
+        ops = g["ops"] if "ops" in g.attributes() else None
+        if g_hier is None:
+            g_hier = self.load_template(ref, ver)
+        g, pass_flag, new_vertices = self.replace_hier_cell(g, g_hier, v1_id, direction, overlay)
+        if ops is not None:
+            g["ops"] = ops + ((direction, ref, ver, v1_id),) if pass_flag == 1 else None
+        return g, pass_flag, new_vertices
+
+    def start_template(self, ref, ver):
+        """Working graph of a search started from a template version"""
+        g_template = self.load_template(ref, ver)
+        g_template["ops"] = (("load", ref, ver, None),)
+        return g_template
+
+    def rebuild_template(self, ops, cached_ops=None, g_cached=None):
+        """
+        Replay an operation log, from a template version loaded by
+        start_template or a checkpoint reopened by open_checkpoint.  When
+        cached_ops is a prefix of ops, only the remaining operations are
+        applied to g_cached (in place).
+        """
+        if cached_ops is not None and ops[: len(cached_ops)] == cached_ops:
+            g_template = g_cached
+        elif ops[0][0] == "checkpoint":
+            cached_ops = ops[:1]
+            g_template, _ = self.open_checkpoint(ops[0][1])
+            index_edges(g_template)
+        else:
+            cached_ops = ops[:1]
+            g_template = self.start_template(*ops[0][1:3])
+        for direction, ref, ver, v1_id in ops[len(cached_ops) :]:
+            g_template, pass_flag, _ = self.apply_template(g_template, ref, ver, v1_id, direction)
+            assert pass_flag == 1
+        return g_template
+
+    def decode_template(self, ref, ver, kind):
+        """
+        Decodes a template from the library, with its edge index, and every
+        vertex tagged with its "origin": (ref, ver, vertex index), see
+        FailureCache.
+        """
+        g = self.library.load(ref, ver, kind)
+        index_edges(g)
+        g.vs["origin"] = [(ref, ver, x) for x in range(g.vcount())]
+        return g
 
     def save_checkpoint(self, g, g_template, mapping):
         CHECKPT_DIR.mkdir(exist_ok=True)
@@ -111,8 +497,12 @@ class IP_Search:
         mapping = {}
         file_name = CHECKPT_DIR / f"checkpoint_{checkpt}.mapping.pkl"
         with open(file_name, "rb") as handle:
-            mapping = pickle.load(handle)
+            # Older checkpoints hold plain dicts
+            mapping = VertexMapping(pickle.load(handle))
         g = Graph.Read_Pickle(str(CHECKPT_DIR / f"checkpoint_{checkpt}.graph"))
+        if "ops" not in g.attributes() or g["ops"] is None:
+            # Older checkpoints have no operation log, workers reopen them
+            g["ops"] = (("checkpoint", checkpt, None, None),)
         return g, mapping
 
     # Checks if the incoming hier template matches port definitions
@@ -131,8 +521,89 @@ class IP_Search:
                 return 1
         return 0
 
+    def port_pre_check(self, g, v1_id, ref, ver):
+        """
+        Same check as replace_pre_check, using the boundary port signature
+        stored in the library index so the template does not have to be loaded.
+        """
+        ports = self.templates[ref][ver].get("ports")
+        if ports is None:
+            return True
+        v1 = g.vs[v1_id]
+        in_pins = {x["in_pin"] for x in v1.in_edges()}
+        out_pins = {x["out_pin"] for x in v1.out_edges()}
+        return in_pins.issuperset(ports["in"]) and out_pins.issuperset(ports["out"])
+
+    def port_context(self, g_template, mapping, v_hier_id):
+        """
+        Boundary port connectivity signature of hier cell v_hier_id: for each
+        of its edges, the direction, the pins at both ends, and the design
+        vertex the far end is mapped to (or its ref while unmapped).  Unlike
+        the vertex index, the signature is the same wherever and whenever the
+        hier cell shows up in a working graph, so descend failures keyed by it
+        (see descend_context) hold across seeds and templates.
+        """
+        if not isinstance(mapping, VertexMapping):
+            mapping = VertexMapping(mapping)
+        refs = g_template.vs["ref"]
+        context = []
+        for e in g_template.incident(v_hier_id, mode="all"):
+            edge = g_template.es[e]
+            if edge.target == v_hier_id:
+                far, pins = edge.source, ("in", edge["in_pin"], edge["out_pin"])
+            else:
+                far, pins = edge.target, ("out", edge["out_pin"], edge["in_pin"])
+            if far in mapping.inverse:
+                context.append(pins + (True, mapping.inverse[far]))
+            else:
+                context.append(pins + (False, refs[far]))
+        return tuple(sorted(context, key=repr))
+
+    def descend_radius(self, ref):
+        """
+        Steps over non-port edges from the neighbours of a hier cell to the
+        furthest vertex of any version of ref spliced in its place, plus one
+        for the GND/VCC cells those connect to (see match_levels).
+        """
+        radius = self.descend_radii.get(ref)
+        if radius is None:
+            radius = 0
+            for ver in self.templates[ref]:
+                g_hier = self.load_template(ref, ver)
+                for x in set(g_hier.neighbors(0)):
+                    radius = max(radius, len(list(match_levels(g_hier, x))) + 1)
+            self.descend_radii[ref] = radius
+        return radius
+
+    def descend_context(self, g, g_template, mapping, v_hier_id, ref):
+        """
+        Key of the descend failures of hier cell v_hier_id: its port_context,
+        and the mapped design vertices within descend_radius(ref) steps of
+        those its neighbours are mapped to.  update_map matches the spliced
+        cells from the neighbours, to design vertices in that reach which
+        are not mapped yet, so no other part of the mapping decides the
+        outcome.  None when a neighbour is an unmapped primitive, which
+        update_map would go on matching from without bound: failures there
+        are not cached.
+        """
+        if not isinstance(mapping, VertexMapping):
+            mapping = VertexMapping(mapping)
+        columns = get_columns(g_template)
+        reach = set()
+        radius = self.descend_radius(ref)
+        for x in set(g_template.neighbors(v_hier_id)):
+            if x in mapping.inverse:
+                reach.update(match_region(g, mapping.inverse[x], radius))
+            elif columns["IS_PRIMITIVE"][x] and columns["ref"][x] not in CONSTANT_REFS:
+                return None
+        return (
+            self.port_context(g_template, mapping, v_hier_id),
+            frozenset(x for x in reach if x in mapping),
+        )
+
     # Replaces the vertex at v1_id in g with g_hier if descend, otherwise replaces top level vertex with v_hier
-    def replace_hier_cell(self, g, g_hier, v1_id, direction):
+    # A descend can be made through a GraphOverlay of g, to be committed or rolled back afterwards
+    def replace_hier_cell(self, g, g_hier, v1_id, direction, overlay=None):
         # print("REPLACING:",len(g.vs),len(g_hier.vs),v1_id,direction)
         original_length = len(g.vs)
         if direction == "ascend":
@@ -142,98 +613,155 @@ class IP_Search:
         if direction == "descend":
             if self.replace_pre_check(g, v1_id, g_hier):
                 return g, 0, []
-        v_dict = {}
-        v_list = []
-        i = len(g.vs)
-        max_id = max(g.vs["id"])
-        new_vertices = []
+
+        # Splice in the template vertices and edges
+        n = len(g_hier.vs)
+        new_vertices = list(range(original_length, original_length + n))
+        v_attrs = {x: g_hier.vs[x] for x in g_hier.vs.attributes() if x not in ADJACENCY_ATTRS}
+        v_attrs["id"] = list(new_vertices)
+        scopes = g["scopes"] if "scopes" in g.attributes() else ()
         if direction == "descend":
-            descend_top_name = g.vs[v1_id]["name"]
-        for v in g_hier.vs:
+            # Names stay local to the replaced cell, see get_names
+            v_attrs["hier_parent"] = [v1_id] * n
+            v_attrs["scope"] = [self.get_scope(g, v1_id)] * n
+        else:
+            v_attrs["hier_parent"] = [None] * n
+            v_attrs["scope"] = [len(scopes)] * n
             # Switch the ID to be replaced with the new ID if switching replacing order (ascending)
-            if direction == "ascend" and v["id"] == v1_id:
-                v1_id = i
-                new_vertices.append(0)
-            v_list.append(v.index)
-            v_dict[v.index] = i
-            g.add_vertices(1, v.attributes())
-            g.vs[i]["id"] = i
-            if direction == "descend":
-                g.vs[i]["name"] = descend_top_name + "/" + g.vs[i]["name"]
-                # print("NEW NAME:",g.vs[i]["name"],descend_top_name)
-            new_vertices.append(i)
-            i += 1
+            hier_ids = g_hier.vs["id"]
+            if v1_id in hier_ids:
+                idx = hier_ids.index(v1_id)
+                v1_id = original_length + idx
+                new_vertices.insert(idx, 0)
+        g.add_vertices(n, v_attrs)
+        extend_columns(g)
+        g.add_edges(
+            [(x + original_length, y + original_length) for x, y in g_hier.get_edgelist()],
+            {x: g_hier.es[x] for x in g_hier.es.attributes()},
+        )
 
+        # Rewire the port edges of the replaced cell, all at once
         v2_top = g.vs[v2_top_id]
         v1 = g.vs[v1_id]
-        for e in g_hier.es:
-            if e.source not in v_dict:
-                print("MISSING:", e.source, e.target, g_hier.vs[e.source]["name"])
-            elif e.target not in v_dict:
-                print("MISSING:", e.source, e.target, g_hier.vs[e.target]["name"])
-            else:
-                g.add_edges([(v_dict[e.source], v_dict[e.target])], e.attributes())
-        v1_port_edges = v1.out_edges() + v1.in_edges()
+        v1_in_edges, v1_out_edges = {}, {}
+        for e1 in v1.in_edges():
+            v1_in_edges.setdefault(e1["in_pin"], []).append(e1)
+        for e1 in v1.out_edges():
+            v1_out_edges.setdefault(e1["out_pin"], []).append(e1)
+        name_attrs = sorted(EDGE_NAME_ATTRS.intersection(g.es.attributes()))
+        port_edges = []
+        e_attrs = {x: [] for x in ["signal", "in_pin", "out_pin"] + name_attrs}
         for e2 in v2_top.out_edges():
-            es1_out = v1.in_edges()
-            es1 = list(x for x in es1_out if x["in_pin"] == e2["out_pin"])
-            if len(es1) == 0:
+            es1 = v1_in_edges.get(e2["out_pin"])
+            if not es1:
                 return g, 0, []
             for e1 in es1:
-                e_new = g.add_edge(e1.source, e2.target)
-                if g.vs[e1.source]["color"] == "green" or g.vs[e2.target]["color"] == "green":
-                    e_new["signal"] = "port"
-                elif g.vs[e1.source]["ref"] == "VCC":
-                    e_new["signal"] = "CONST1"
-                elif g.vs[e1.source]["ref"] == "GND":
-                    e_new["signal"] = "CONST0"
-                else:
-                    e_new["signal"] = "primitive"
-                e_new["parent"] = e2["parent"]
-                e_new["name"] = e2["name"]
-                e_new["in_pin"] = e2["in_pin"]
-                e_new["out_pin"] = e1["out_pin"]
+                port_edges.append((e1.source, e2.target))
+                e_attrs["in_pin"].append(e2["in_pin"])
+                e_attrs["out_pin"].append(e1["out_pin"])
+                for attr in name_attrs:
+                    e_attrs[attr].append(e2[attr])
         for e2 in v2_top.in_edges():
-            es1_out = v1.out_edges()
-            es1 = list(x for x in es1_out if x["out_pin"] == e2["in_pin"])
-            if len(es1) == 0:
+            es1 = v1_out_edges.get(e2["in_pin"])
+            if not es1:
                 # if e2["out_pin"] != "G":
                 return g, 0, []
             for e1 in es1:
-                e_new = g.add_edge(e2.source, e1.target)
-                if g.vs[e2.source]["color"] == "green" or g.vs[e1.target]["color"] == "green":
-                    e_new["signal"] = "port"
-                elif g.vs[e2.source]["ref"] == "VCC":
-                    e_new["signal"] = "CONST1"
-                elif g.vs[e2.source]["ref"] == "GND":
-                    e_new["signal"] = "CONST0"
-                else:
-                    e_new["signal"] = "primitive"
-                e_new["parent"] = e2["parent"]
-                e_new["name"] = e2["name"]
-                e_new["in_pin"] = e1["in_pin"]
-                e_new["out_pin"] = e2["out_pin"]
-        v2_top["color"] = "black"
+                port_edges.append((e2.source, e1.target))
+                e_attrs["in_pin"].append(e1["in_pin"])
+                e_attrs["out_pin"].append(e2["out_pin"])
+                for attr in name_attrs:
+                    e_attrs[attr].append(e2[attr])
+        columns = get_columns(g)
+        colors, refs = columns["color"], columns["ref"]
+        for source, target in port_edges:
+            if colors[source] == "green" or colors[target] == "green":
+                e_attrs["signal"].append("port")
+            elif refs[source] == "VCC":
+                e_attrs["signal"].append("CONST1")
+            elif refs[source] == "GND":
+                e_attrs["signal"].append("CONST0")
+            else:
+                e_attrs["signal"].append("primitive")
+        g.add_edges(port_edges, e_attrs)
+        set_vertex_attr(g, v2_top_id, "color", "black")
         v1_top = g.vs[v1_id]
-        v1_top["color"] = "black"
         remove_es = v2_top.in_edges() + v2_top.out_edges() + v1_top.in_edges() + v1_top.out_edges()
-        g.delete_edges(remove_es)
+        if overlay is None:
+            set_vertex_attr(g, v1_id, "color", "black")
+            g.delete_edges(remove_es)
+        else:
+            overlay.set_vertex(v1_id, "color", "black")
+            overlay.delete_edges(remove_es)
+        if direction == "descend":
+            # Only the spliced cells and the ends of the rewired edges have new non-port edges
+            touched = set(new_vertices).union(*port_edges)
+            index_edges(g, sorted(touched), overlay)
         if direction == "ascend":
             contracted_order = list(range(0, len(g.vs)))
             contracted_order[0] = original_length
             contracted_order[original_length] = 0
             g.contract_vertices(contracted_order, "first")
             g.vs[0]["id"] = 0
-            top_name = g.vs[0]["name"]
             g.vs[original_length]["id"] = original_length
-            for i in range(1, len(g.vs)):
-                g.vs[i]["name"] = top_name + "/" + g.vs[i]["name"]
+            # The contraction only swaps the old and the new top, in the column view too
+            for v_id in (0, original_length):
+                attrs = g.vs[v_id].attributes()
+                for attr in COLUMN_ATTRS:
+                    if attr in attrs and attr not in ADJACENCY_ATTRS:
+                        set_vertex_attr(g, v_id, attr, attrs[attr])
+            # Every vertex below the new top is now under its name, see get_names
+            g["scopes"] = scopes + (g.vs[0]["name"],)
+            g.vs[0]["scope"] = len(scopes) + 1
+            # Spliced cells, ends of the rewired edges and neighbours of the swapped tops
+            touched = set(range(original_length, original_length + n)).union(*port_edges)
+            touched = {contracted_order[x] for x in touched}
+            touched.update(*g.neighborhood([0, original_length]))
+            index_edges(g, sorted(touched))
 
         return g, 1, new_vertices
 
+    def get_scope(self, g, v_id):
+        scope = g.vs[v_id]["scope"] if "scope" in g.vs.attributes() else None
+        return scope or 0
+
+    def get_names(self, g):
+        """
+        Full hierarchical names of the vertices of a working graph, which are
+        only built for output; graph surgery never touches names.
+
+        A vertex spliced in by a descend keeps its local name and points at the
+        replaced cell ("hier_parent"), whose full name it extends.  Instead of
+        renaming every vertex, an ascend records the name of the new top in
+        the "scopes" graph attribute.  The name of a vertex without a parent is
+        prefixed by the scopes recorded from its "scope" index on, the latest
+        outermost.
+        """
+        scopes = g["scopes"] if "scopes" in g.attributes() else ()
+        prefixes = ["/".join(reversed(scopes[i:])) for i in range(len(scopes) + 1)]
+        local_names = g.vs["name"]
+        levels = g.vs["scope"] if "scope" in g.vs.attributes() else [0] * len(g.vs)
+        if "hier_parent" in g.vs.attributes():
+            parents = g.vs["hier_parent"]
+        else:
+            parents = [None] * len(g.vs)
+        names = [None] * len(g.vs)
+        for v_id in range(len(g.vs)):
+            path = []
+            while v_id is not None and names[v_id] is None:
+                path.append(v_id)
+                v_id = parents[v_id]
+            for j in reversed(path):
+                if parents[j] is not None:
+                    names[j] = names[parents[j]] + "/" + local_names[j]
+                else:
+                    prefix = prefixes[levels[j] or 0]
+                    names[j] = prefix + "/" + local_names[j] if prefix else local_names[j]
+        return names
+
     def get_spanning_hier_cells(self, g_template, mapping, limit_vertices):
         """Gets all hier cells connected to the limit_vertices list"""
-        mapped_id = mapping.values() if limit_vertices is not None else limit_vertices
+        mapped_id = mapping.values() if limit_vertices is None else limit_vertices
 
         max_v = len(g_template.vs)
         mapped_id = [x for x in mapped_id if x < max_v]
@@ -248,9 +776,8 @@ class IP_Search:
         return hier_vs_id
 
     def update_map(self, g, g_template, mapping, new_vertices, verbose):
-        original_map = dict(mapping)
-        self.mapped_list = list(mapping.values())
-        mapped_keys = list(mapping.keys())
+        if not isinstance(mapping, VertexMapping):
+            mapping = VertexMapping(mapping)
 
         # It would be faster to get unmapped_neighbor by just passing in the new vertices and getting those neighbors
         # also only run the descending function on green neighbors of the new vertices?
@@ -258,17 +785,17 @@ class IP_Search:
         unmapped_neighbor = set()
         for x in new_vertices:
             for y in g_template.neighbors(x, mode="all"):
-                if y in self.mapped_list:
+                if y in mapping.inverse:
                     unmapped_neighbor.add(y)
         unmapped_neighbor = list(unmapped_neighbor)
         edge_limit = 200
         # This prevents cells who are connected to tons of things from being run frequently
         # Example: FF whose output is connected to hundreds of other FF's CE pin.
         for x in unmapped_neighbor:
-            key = mapped_keys[self.mapped_list.index(x)]
+            key = mapping.inverse[x]
             if len(g_template.vs[x].out_edges()) < edge_limit:
                 tmp_mapping = compare_vertex(
-                    mapping, g, g.vs[key], g_template, g_template.vs[x], 0, verbose
+                    mapping, g, g.vs[key], g_template, g_template.vs[x], failures=self.failure_cache
                 )
                 if not tmp_mapping:
                     return 0
@@ -280,95 +807,119 @@ class IP_Search:
     def print_map_cells(self, mapping, g, g_template):
         # return
         err_count = 0
+        names = self.get_names(g_template)
         for x in sorted(mapping):
             # print(x,return_mapping[x])
             a = g.vs[x]["CELL_NAME"].split("/")[-1]
-            b = g_template.vs[mapping[x]]["name"]
+            b = names[mapping[x]]
             if a != b:
                 print("\t\t\t", x, mapping[x], a, " -> ", b, "####### NOT EQUAL")
                 err_count += 1
             else:
                 print("\t\t\t", x, mapping[x], a, " -> ", b)
 
-    def descend_parallel(self, ver):
-        g_hier = Graph.Read_Pickle(self.templates[self.ref][ver]["file"])
-        g_new = self.g_temp.copy()
-        g_new, pass_flag, new_vertices = self.replace_hier_cell(
-            g_new, g_hier, self.v_par_id, "descend"
+    def descend_template(self, g, g_template, mapping, ref, ver, v1_id):
+        """
+        Descend into hier cell v1_id of a copy of g_template with a template
+        version and extend the mapping over the new cells.  Returns the new
+        graph, mapping and vertices, or None if the version does not match.
+        """
+        overlay = GraphOverlay(g_template)
+        _, pass_flag, new_vertices = self.apply_template(
+            g_template, ref, ver, v1_id, "descend", overlay
         )
-        tmp_graph = g_new.copy()
         if pass_flag == 1:
-            mapping = self.update_map(self.g_par, g_new, dict(self.return_mapping), new_vertices, 0)
+            mapping = self.update_map(g, g_template, mapping.copy(), new_vertices, 0)
             if mapping != 0:
-                if self.ret_graph == 1:
-                    return tmp_graph.copy(), dict(mapping), new_vertices
-                elif self.ret_graph == 2:
-                    return len(mapping)
-                else:
-                    return 1
-        return 0
+                return overlay.commit(copy=True), mapping, new_vertices
+        overlay.rollback()
+        return None
 
-    def descend(self, g, g_template, pass_mapping, limit_vertices):
+    def try_descend(self, g, g_template, mapping, ref, ver, v1_id):
+        """
+        Size of the mapping after descending into hier cell v1_id with a
+        template version, or 0 if it does not match.  g_template is edited in
+        place and rolled back.
+        """
+        overlay = GraphOverlay(g_template)
+        _, pass_flag, new_vertices = self.apply_template(
+            g_template, ref, ver, v1_id, "descend", overlay
+        )
+        if pass_flag == 1:
+            mapping = self.update_map(g, g_template, mapping.copy(), new_vertices, 0)
+        overlay.rollback()
+        return len(mapping) if pass_flag == 1 and mapping != 0 else 0
+
+    def descend(self, g, g_template, pass_mapping, limit_vertices, frontier=None):
+        """
+        Descend into the hier cells next to the mapped vertices (or to
+        limit_vertices), then into those next to the cells spliced in, while
+        a single template version matches.  frontier, the Frontier of the
+        mapped vertices, is built if not given, and updated in place to
+        match the returned graph and mapping.
+        """
         return_mapping = pass_mapping
         descend_pass_flag = 1
         best_length = 0
         best_average = 0
         best_decision = None
+        if frontier is None:
+            frontier = Frontier(g_template, return_mapping.values())
+        # Hier cells next to limit_vertices and the vertices spliced in since
+        spliced = Frontier(g_template, limit_vertices or ())
+        first = frontier if limit_vertices is None else spliced
+        v_hier_id_list = first.hier_cells(g_template)
         while 1:
             decision_list = []
-            v_hier_id_list = self.get_spanning_hier_cells(g_template, pass_mapping, limit_vertices)
             updated_flag = 0
             for v_hier_id in v_hier_id_list:
-
-                if v_hier_id not in self.descend_failed_dict:
-                    self.descend_failed_dict[v_hier_id] = []
-                self.ref = g_template.vs.find(id=v_hier_id)["ref"]
+                ref = g_template.vs.find(id=v_hier_id)["ref"]
+                context = self.descend_context(g, g_template, return_mapping, v_hier_id, ref)
                 pass_num = 0
                 possible_matches = []
                 average = 0
                 new_vertex_list = []
-                self.g_temp = g_template
-                self.g_par = g
-                v_par_id = v_hier_id
-                self.ret_graph = 2
                 versions = list(
                     x
-                    for x in self.templates[self.ref].keys()
-                    if x not in self.descend_failed_dict[v_par_id]
+                    for x in self.templates[ref].keys()
+                    if context is None
+                    or (ref, x, context) not in self.descend_failures
+                    and self.port_pre_check(g_template, v_hier_id, ref, x)
                 )
-                pool = Pool(processes=8)
-                results = pool.map(self.descend_parallel, versions)
+                results = self.map_descend(g, g_template, return_mapping, ref, versions, v_hier_id)
                 for idx, x in enumerate(results):
                     if x:
                         pass_num += 1
                         possible_matches.append(versions[idx])
-                        average += self.templates[self.ref][versions[idx]]["primitive_count"]
-                    else:
-                        self.descend_failed_dict[v_par_id].append(versions[idx])
+                        average += self.templates[ref][versions[idx]]["primitive_count"]
+                    elif context is not None:
+                        self.descend_failures.add((ref, versions[idx], context))
                 average = average / pass_num if pass_num != 0 else 0
                 # print("AVERAGE:",average,pass_num,best_average)
                 if average >= best_average:
                     best_average = average
-                    decision_list = [v_par_id, self.ref, possible_matches]
+                    decision_list = [v_hier_id, ref, possible_matches]
                 if pass_num == 1:
-                    self.ret_graph = 1
-                    g_template, return_mapping, new_vertex_list = self.descend_parallel(
-                        possible_matches[0]
+                    neighbors = g_template.neighbors(v_hier_id)
+                    mapped = len(return_mapping)
+                    g_template, return_mapping, new_vertex_list = self.descend_template(
+                        g, g_template, return_mapping, ref, possible_matches[0], v_hier_id
                     )
-                    if limit_vertices != None:
-                        limit_vertices += new_vertex_list
-                    else:
-                        limit_vertices = new_vertex_list
+                    frontier.replace(
+                        g_template, v_hier_id, neighbors, return_mapping.added_since(mapped)
+                    )
+                    spliced.replace(g_template, v_hier_id, neighbors, new_vertex_list)
                     updated_flag = 1
                 elif pass_num > 1:
                     for idx, x in enumerate(results):
                         if x > best_length:
-                            best_decision = [v_par_id, self.ref, versions[idx]]
+                            best_decision = [v_hier_id, ref, versions[idx]]
                             best_length = x
                 else:
                     descend_pass_flag = 0
             if updated_flag == 0:
                 break
+            v_hier_id_list = spliced.hier_cells(g_template)
 
         return (
             g_template,
@@ -378,6 +929,29 @@ class IP_Search:
             decision_list,
         )
 
+    def map_descend(self, g, g_template, mapping, ref, versions, v1_id):
+        """
+        Size of the mapping after descending into hier cell v1_id with each of
+        the versions (0 if it does not match).  Runs on the worker pool if one
+        is open.
+        """
+        if self.pool is None or len(versions) < 2:
+            return [self.try_descend(g, g_template, mapping, ref, ver, v1_id) for ver in versions]
+        key = self.sent_state[0] + 1 if self.sent_state is not None else 0
+        state = SearchState(g_template, mapping, key, self.sent_state)
+        tasks = [(state, ref, ver, v1_id) for ver in versions]
+        results = self.pool.map(descend_task, tasks, chunksize=-(-len(tasks) // WORKERS))
+        # Workers without the base state get the whole mapping
+        missed = [i for i, x in enumerate(results) if x is None]
+        if missed:
+            state = SearchState(g_template, mapping, key)
+            tasks = [(state, ref, versions[i], v1_id) for i in missed]
+            retried = self.pool.map(descend_task, tasks, chunksize=-(-len(tasks) // WORKERS))
+            for i, result in zip(missed, retried):
+                results[i] = result
+        self.sent_state = (key, mapping.copy())
+        return results
+
     def ascend(self, g, g_template, pass_mapping):
         pass_graph = ""
         return_mapping = pass_mapping
@@ -387,44 +961,46 @@ class IP_Search:
         pass_num = 0
         updated_flag = 0
         if root_node["ref"] in self.used_list:
-            for self.ref in self.used_list[root_node["ref"]]:
+            for ref in self.used_list[root_node["ref"]]:
                 possible_matches = []
-                for ver in self.templates[self.ref]:
-                    g_hier = Graph.Read_Pickle(self.templates[self.ref][ver]["file"])
-
-                    g_new = g_template.copy()
+                for ver in self.templates[ref]:
+                    g_hier = self.load_template(ref, ver)
                     v_hier_top_s = g_hier.vs.select(ref=root_node["ref"])
                     for v_hier_top in v_hier_top_s:
-                        g_new, pass_flag, new_vertices = self.replace_hier_cell(
-                            g_new, g_hier, v_hier_top["id"], "ascend"
+                        g_new = g_template.copy()
+                        copy_columns(g_template, g_new)
+                        g_new, pass_flag, new_vertices = self.apply_template(
+                            g_new, ref, ver, v_hier_top["id"], "ascend", g_hier=g_hier
                         )
-                        tmp_graph = g_new.copy()
                         if pass_flag == 1:
                             mapping = self.update_map(
-                                g, g_new, dict(return_mapping), new_vertices, 0
+                                g, g_new, return_mapping.copy(), new_vertices, 0
                             )
                             if mapping != 0:
                                 pass_num += 1
                                 possible_matches.append((ver, v_hier_top.index))
                                 if pass_num == 1:
-                                    pass_graph = tmp_graph.copy()
-                                    pass_mapping = dict(mapping)
+                                    pass_graph = g_new
+                                    pass_mapping = mapping.copy()
                 if len(possible_matches) > 0:
-                    decision_list[self.ref] = possible_matches
+                    decision_list[ref] = possible_matches
         if pass_num == 1:
-            g_template = pass_graph.copy()
-            return_mapping = dict(pass_mapping)
+            g_template = pass_graph
+            return_mapping = pass_mapping.copy()
             updated_flag = 1
         return g_template, return_mapping, decision_list
 
-    def recurse_descend(self, descend_decision_dec, g, g_template, mapping, depth):
+    def recurse_descend(self, descend_decision_dec, g, g_template, mapping, depth, frontier=None):
         # print("\tRECURSE DESCEND")
-        self.ret_graph = 1
-        self.ref = descend_decision_dec[1]
-        self.v_par_id = descend_decision_dec[0]
-        g_descended, mapping_descended, new_vertex_list = self.descend_parallel(
-            descend_decision_dec[2]
+        v_par_id, ref, ver = descend_decision_dec
+        neighbors = g_template.neighbors(v_par_id)
+        g_descended, mapping_descended, new_vertex_list = self.descend_template(
+            g, g_template, mapping, ref, ver, v_par_id
         )
+        if frontier is not None:
+            frontier.replace(
+                g_descended, v_par_id, neighbors, mapping_descended.added_since(len(mapping))
+            )
         return g_descended, mapping_descended, 1
 
     def recurse_ascend(self, ascend_decision_list, g, g_template, mapping, depth):
@@ -436,19 +1012,19 @@ class IP_Search:
             for decision in ascend_decision_list[x]:
                 ref = x
                 ver, v_id = decision
-                g_hier = Graph.Read_Pickle(self.templates[ref][ver]["file"])
                 g_new = g_template.copy()
-                g_new, pass_flag, new_vertices = self.replace_hier_cell(
-                    g_new, g_hier, v_id, "ascend"
+                copy_columns(g_template, g_new)
+                g_new, pass_flag, new_vertices = self.apply_template(
+                    g_new, ref, ver, v_id, "ascend"
                 )
-                tmp_mapping = self.update_map(g, g_new, dict(mapping), new_vertices, 0)
+                tmp_mapping = self.update_map(g, g_new, mapping.copy(), new_vertices, 0)
                 if GREEDY:
                     g_tmp, tmp_mapping = self.run_replace_greedy(g, g_new, tmp_mapping, depth + 1)
                 else:
                     g_tmp = g_new
                 if len(tmp_mapping) >= len(mapping_ascended):
                     g_ascended = g_tmp.copy()
-                    mapping_ascended = dict(tmp_mapping)
+                    mapping_ascended = tmp_mapping.copy()
         if len(mapping_ascended) > len(mapping):
             return g_ascended, mapping_ascended, 0
         else:
@@ -458,6 +1034,8 @@ class IP_Search:
         if depth >= 2:
             return g_template, mapping
 
+        # Hier cells next to the mapped vertices, carried from one pass to the next
+        frontier = Frontier(g_template, mapping.values())
         while 1:
             # Try every decision
             descend_decision_dec, ascend_decision_dec = None, []
@@ -470,14 +1048,18 @@ class IP_Search:
                     descend_decision_dec,
                     descend_pass_flag,
                     dec_list,
-                ) = self.descend(g, g_template, mapping, None)
+                ) = self.descend(g, g_template, mapping, None, frontier)
+                g_descended = g_template
                 g_template, mapping, ascend_decision_list = self.ascend(g, g_template, mapping)
+                if g_template is not g_descended:
+                    # The ascend renumbers the graph
+                    frontier = Frontier(g_template, mapping.values())
                 if len(g_template.vs) == original_length:
                     break
             # Descend/Ascend has settled - need to try decisions now
             if descend_decision_dec != None:
                 g_template, mapping, recurse_pass_flag = self.recurse_descend(
-                    descend_decision_dec, g, g_template, mapping, depth
+                    descend_decision_dec, g, g_template, mapping, depth, frontier
                 )
             else:
                 g_template, mapping, recurse_pass_flag = self.recurse_ascend(
@@ -489,6 +1071,8 @@ class IP_Search:
                 and len(ascend_decision_list) == 0
             ):
                 return g_template, mapping
+            if descend_decision_dec == None:
+                frontier = Frontier(g_template, mapping.values())
         return None
 
     def run_replace(self, g, g_template, mapping, depth):
@@ -523,16 +1107,11 @@ class IP_Search:
             if len(dec_list) != 0:
                 # print("DESCENDING RECURSIVE:",dec_list)
                 for x in dec_list[2]:
-                    self.ref = dec_list[1]
-                    self.v_par_id = dec_list[0]
-                    self.g_temp = g_template
-                    self.g_par = g
-                    self.ret_graph = 1
                     (
                         g_descended,
                         mapping_descended,
                         new_vertex_list,
-                    ) = self.descend_parallel(x)
+                    ) = self.descend_template(g, g_template, mapping, dec_list[1], x, dec_list[0])
                     g_descended, mapping_descended = self.run_replace(
                         g, g_descended, mapping_descended, depth + 1
                     )  # Recurse
@@ -555,50 +1134,255 @@ class IP_Search:
 
     def find_template(self, g, g_template, template, version, span_in):
         biggest_map, biggest_graph = [], None
+        # Design vertices inside the matches found so far, not seeded from again
+        covered = set()
         # have span max be on a sliding scale - based off of len(templates)
-        for span in span_in:
-            if span["size"] <= 5:
-                has_complex_prim = False
-                for x in span["indices"]:
-                    if g_template.vs[x]["ref"] in ["DSP48E1"]:
-                        has_complex_prim = True
-                        break
-                if has_complex_prim is False:
-                    continue
-            v2 = g_template.vs[span["indices"][0]]
+        for i, span in enumerate(span_in):
+            if self.skip_span(g_template, span) or not self.span_fits(span):
+                continue
+            v2 = g_template.vs[self.get_span_anchor(g_template, span)]
             # print("\tNEW SPAN:", span["indices"], template, version)
-            for v in g.vs.select(ref=v2["ref"]):
-                mapping = {}
-                mapping[v.index] = v2.index
-                mapping = compare_vertex(mapping, g, v, g_template, v2, 0)
-
-                if mapping and len(mapping) > 1:
-                    # print("####### STARTING NEW FIND TEMPLATE: #######")
-                    if GREEDY:
-                        g_tmp_template, tmp_mapping = self.run_replace_greedy(
-                            g, g_template, mapping, 0
-                        )
-                    else:
-                        g_tmp_template, tmp_mapping = self.run_replace(g, g_template, mapping, 0)
-                    self.save_checkpoint(g, g_tmp_template, tmp_mapping)
-                    if len(tmp_mapping) > len(biggest_map):
-                        biggest_map = tmp_mapping
-                        biggest_graph = g_tmp_template.copy()
+            domains = self.span_domains(g, g_template, v2.index)
+            self.domain_sizes[(template, version, i)] = min(map(len, domains.values()))
+            if not all(domains.values()):
+                # Some vertex the anchor reaches has no candidate, nothing can match
+                continue
+            region = list(domains)
+            # LAD only retries the seeds compare_vertex_batch did not match
+            matcher = None
+            if LAD_BACKEND and LadMatcher.qualifies(g_template, region):
+                matcher = LadMatcher(g, g_template, region, domains)
+            self.span_backends[(template, version, i)] = "lad" if matcher else "python"
+            candidates = None
+            if self.library_seeds is not None:
+                candidates = self.library_seeds.get((template, version, i))
+            if candidates is None:
+                candidates = self.rank_seeds(g, g_template, v2.index)
+            candidates = [x for x in candidates if x in domains[v2.index]]
+            for start in range(0, len(candidates), SEED_BATCH_SIZE):
+                chunk = candidates[start : start + SEED_BATCH_SIZE]
+                if not FIND_OVERLAPPING:
+                    chunk = [x for x in chunk if x not in covered]
+                batch = compare_vertex_batch(
+                    g, chunk, g_template, v2.index, domains, self.failure_cache
+                )
+                for v_id, mapping in zip(chunk, batch):
+                    if not FIND_OVERLAPPING and v_id in covered:
+                        continue
+                    if not mapping and matcher is not None:
+                        mapping = matcher.match(v_id, v2.index)
+                    if mapping and len(mapping) > 1:
+                        # print("####### STARTING NEW FIND TEMPLATE: #######")
+                        if GREEDY:
+                            g_tmp_template, tmp_mapping = self.run_replace_greedy(
+                                g, g_template, mapping, 0
+                            )
+                        else:
+                            g_tmp_template, tmp_mapping = self.run_replace(
+                                g, g_template, mapping, 0
+                            )
+                        self.save_checkpoint(g, g_tmp_template, tmp_mapping)
+                        covered.update(mapping)
+                        if tmp_mapping:
+                            covered.update(tmp_mapping)
+                        if len(tmp_mapping) > len(biggest_map):
+                            biggest_map = tmp_mapping
+                            biggest_graph = g_tmp_template.copy()
         return biggest_graph, biggest_map
 
+    def skip_span(self, g_template, span):
+        """Small spans are only searched for when they have a complex primitive"""
+        if span["size"] > 5:
+            return False
+        for x in span["indices"]:
+            if g_template.vs[x]["ref"] in ["DSP48E1"]:
+                return False
+        return True
+
+    def span_fits(self, span):
+        """
+        Whether the design has as many vertices of every ref as a span needs
+        to match, from the ref histogram stored with it in the library
+        """
+        return all(
+            len(self.seeds.get(ref, ())) >= count
+            for ref, count in span.get("ref_histogram", {}).items()
+        )
+
+    def index_seeds(self, g):
+        """Design vertices by ref, the seed candidates of find_template"""
+        seeds = {}
+        for v_id, ref in enumerate(get_columns(g)["ref"]):
+            seeds.setdefault(ref, []).append(v_id)
+        return seeds
+
+    def get_span_anchor(self, g_template, span):
+        """
+        The vertex of a span to seed the search from: the one whose ref is
+        rarest in the design.  Among equally rare refs, the anchor picked
+        from the library when it was built, then the most connected one.
+        """
+        refs = get_columns(g_template)["ref"]
+        anchor = span.get("anchor")
+        return min(
+            span["indices"],
+            key=lambda x: (
+                len(self.seeds.get(refs[x], ())),
+                x != anchor,
+                -g_template.degree(x),
+            ),
+        )
+
+    def span_domains(self, g, g_template, v2_id):
+        """
+        Candidate design vertices of every template vertex compare_vertex can
+        reach from v2_id (see match_region), pruned by refine_domains.  The
+        candidates of a vertex pass seed_filter, or only compare_ref for the
+        constant vertices, whose edges are only checked from their
+        neighbours.  Vertices with the same anchor_key share the filtering.
+        """
+        g_columns, t_columns = get_columns(g), get_columns(g_template)
+        template_signatures = SignatureIndex(g_template)
+        candidates = {}
+        domains = {}
+        for v2 in match_region(g_template, v2_id):
+            key = self.anchor_key(g_template, v2, template_signatures)
+            if key not in candidates:
+                seeds = self.seeds.get(t_columns["ref"][v2], ())
+                if t_columns["ref"][v2] in CONSTANT_REFS:
+                    candidates[key] = [
+                        x for x in seeds if compare_ref_columns(g_columns, x, t_columns, v2)
+                    ]
+                else:
+                    surplus = self.seed_filter(g, g_template, v2, template_signatures)
+                    candidates[key] = [x for x in seeds if surplus(x) is not None]
+            domains[v2] = set(candidates[key])
+        return refine_domains(g, g_template, domains)
+
+    def seed_filter(self, g, g_template, v2_id, template_signatures=None):
+        """
+        Check of the design vertices to match template vertex v2_id from: a
+        function of a design vertex id, giving None when the vertex can not
+        match, otherwise its number of extra edges.  Candidates have the ref
+        and properties of v2_id, at least as many edges as it has of every
+        pin and signal label, see index_edges, and a neighbourhood signature
+        containing its own, see SignatureIndex.
+        """
+        g_columns, t_columns = get_columns(g), get_columns(g_template)
+        signature = (template_signatures or SignatureIndex(g_template))[v2_id]
+        wanted = [
+            [(label, len(neighbors)) for label, neighbors in groups]
+            for groups in t_columns.adjacency(g_template, v2_id)
+        ]
+
+        def surplus(v_id):
+            if not compare_ref_columns(g_columns, v_id, t_columns, v2_id):
+                return None
+            extra = 0
+            for counts, groups in zip(wanted, g_columns.adjacency(g, v_id)):
+                found = {label: len(neighbors) for label, neighbors in groups}
+                if any(found.get(label, 0) < count for label, count in counts):
+                    return None
+                extra += sum(found.values()) - sum(count for _, count in counts)
+            if not self.signatures.contains(v_id, signature):
+                return None
+            return extra
+
+        return surplus
+
+    def rank_seeds(self, g, g_template, v2_id):
+        """
+        Design vertices to match template vertex v2_id from, in find_template:
+        the ones passing seed_filter, those with the fewest extra edges first.
+        """
+        surplus = self.seed_filter(g, g_template, v2_id)
+        ranked = []
+        for v_id in self.seeds.get(get_columns(g_template)["ref"][v2_id], ()):
+            extra = surplus(v_id)
+            if extra is not None:
+                ranked.append((extra, v_id))
+        ranked.sort()
+        return [v_id for _, v_id in ranked]
+
+    def anchor_key(self, g_template, v2_id, template_signatures=None):
+        """
+        Local structure of a template vertex: everything seed_filter checks,
+        so anchors with the same key have the same candidates.
+        """
+        columns = get_columns(g_template)
+        adjacency = columns.adjacency(g_template, v2_id)
+        return (
+            freeze(tuple(columns[x][v2_id] for x in STRUCTURE_ATTRS)),
+            tuple(tuple((label, len(neighbors)) for label, neighbors in x) for x in adjacency),
+            freeze((template_signatures or SignatureIndex(g_template))[v2_id]),
+        )
+
+    def index_library_seeds(self, g):
+        """
+        Inverted seed index of the whole library.  The span anchors of every
+        template version are grouped by anchor_key, and the candidates of all
+        groups are found in one pass over the design, so versions sharing an
+        anchor structure are only ranked once.
+
+        Returns {(ref, ver, span number): [design vertex ids]}, in the order
+        of rank_seeds.
+        """
+        groups = {}
+        keys_by_ref = {}
+        for ref, versions in self.templates.items():
+            for ver, entry in versions.items():
+                spans = [(i, x) for i, x in enumerate(entry["span"]) if self.span_fits(x)]
+                if not spans:
+                    # Not loaded when the design is missing refs of every span
+                    continue
+                g_template = self.load_template(ref, ver)
+                for i, span in spans:
+                    if self.skip_span(g_template, span):
+                        continue
+                    v2_id = self.get_span_anchor(g_template, span)
+                    key = self.anchor_key(g_template, v2_id)
+                    if key not in groups:
+                        groups[key] = (self.seed_filter(g, g_template, v2_id), [], [])
+                        keys_by_ref.setdefault(g_template.vs[v2_id]["ref"], []).append(key)
+                    groups[key][1].append((ref, ver, i))
+
+        for v_id, v_ref in enumerate(get_columns(g)["ref"]):
+            for key in keys_by_ref.get(v_ref, ()):
+                surplus, _, ranked = groups[key]
+                extra = surplus(v_id)
+                if extra is not None:
+                    ranked.append((extra, v_id))
+
+        library_seeds = {}
+        for _, spans, ranked in groups.values():
+            ranked.sort()
+            candidates = [v_id for _, v_id in ranked]
+            for span_key in spans:
+                library_seeds[span_key] = candidates
+        return library_seeds
+
     def search(self, g):
         biggest_map = []
         biggest_graph = None
 
-        for k1, v1 in self.templates.items():
-            for k2, v2 in v1.items():
-                g_template = Graph.Read_Pickle(v2["file"])
-                g_template_tmp, tmp_template_mapping = self.find_template(
-                    g, g_template, k1, k2, v2["span"]
-                )
-                if tmp_template_mapping != 0 and len(tmp_template_mapping) > len(biggest_map):
-                    biggest_map = tmp_template_mapping
-                    biggest_graph = g_template_tmp.copy()
+        index_edges(g)
+        # The design does not change during the search, its attributes are read from columns
+        get_columns(g)
+        self.seeds = self.index_seeds(g)
+        self.signatures = SignatureIndex(g)
+        self.library_seeds = self.index_library_seeds(g)
+        with self.worker_pool(g):
+            for k1, v1 in self.templates.items():
+                for k2, v2 in v1.items():
+                    if not any(self.span_fits(x) for x in v2["span"]):
+                        continue
+                    g_template = self.start_template(k1, k2)
+                    g_template_tmp, tmp_template_mapping = self.find_template(
+                        g, g_template, k1, k2, v2["span"]
+                    )
+                    if tmp_template_mapping != 0 and len(tmp_template_mapping) > len(biggest_map):
+                        biggest_map = tmp_template_mapping
+                        biggest_graph = g_template_tmp.copy()
 
         return biggest_graph, biggest_map
 
@@ -613,16 +1397,21 @@ class IP_Search:
 
     def start_from_checkpoint(self, g, i):
         g_template, mapping = self.open_checkpoint(i)
-        return self.run_replace(g, g_template, mapping, 0)
+        index_edges(g)
+        index_edges(g_template)
+        get_columns(g)
+        with self.worker_pool(g):
+            return self.run_replace(g, g_template, mapping, 0)
 
     def print_all_cells(self, g, g_template, mapping):
         for x in mapping:
             print(g.vs[x]["CELL_NAME"])
         err_count = 0
+        names = self.get_names(g_template)
         for x in mapping:
             # print(x,return_mapping[x])
             a = g.vs[x]["CELL_NAME"]
-            b = g_template.vs[mapping[x]]["name"]
+            b = names[mapping[x]]
             if a.split("/")[-1] != b.split("/")[-1]:
                 print("\t\t\t", x, mapping[x], a, " -> ", b, "####### NOT EQUAL")
                 err_count += 1
@@ -667,8 +1456,9 @@ class IP_Search:
         """
         design = {"LEAF": []}
 
+        names = self.get_names(g_template)
         for x in g_template.vs:
-            hier = x["name"].split("/")
+            hier = names[x.index].split("/")
             hier_ptr = design
 
             if x["color"] == "orange":
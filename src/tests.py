@@ -6,17 +6,222 @@ functions in commit 586bf1bc1dd94739c3c9f663d7da89253b8ee930.
 """
 
 import json
+import pickle
+import tempfile
 import unittest
+from unittest import mock
+from pathlib import Path
 from igraph import Graph
 
 from config import TEST_RESOURCES
-from compare_v import import_design
+from compare_v import compare_ref, compare_vertex, import_design
+from compare_v_refactor import (
+    GraphColumns,
+    LadMatcher,
+    SignatureIndex,
+    VertexMapping,
+    get_columns,
+    match_region,
+)
+from compare_v_refactor import compare_ref as compare_ref_refactor
+from compare_v_refactor import compare_vertex as compare_vertex_refactor
+from compare_v_refactor import compare_vertex_batch
 from compare_v_refactor import import_design as import_design_refactor
+from compare_v_refactor import compare_ref_columns, index_edges, refine_domains, vertex_adjacency
 from compare_v_refactor import print_graph
+from create_lib import LibraryGenerator
+from packed_lib import PACKED_LIB_NAME, PackedLibrary, pack_graph, unpack_graph
+from search_lib_refactor import (
+    GraphOverlay,
+    IP_Search,
+    FailureCache,
+    Frontier,
+    SearchState,
+    TemplateCache,
+    descend_task,
+    init_worker,
+)
 
 IPREC_OUTPUT = TEST_RESOURCES / "aes128" / "iprec_output"
 
 
+def make_cell(parent, ref, is_primitive, properties=None):
+    """Cell entry in the format written by record_core"""
+    cell = {"REF_NAME": ref, "PARENT": parent, "PRIM_COUNT": 1, "IS_PRIMITIVE": int(is_primitive)}
+    if is_primitive:
+        cell["BEL_PROPERTIES"] = dict(properties or {})
+    else:
+        cell["ORIG_REF_NAME"] = ref
+        cell["CELL_PROPERTIES"] = dict(properties or {})
+    return cell
+
+
+def make_net(parent, driver, leaf_outputs=(), leaf_inputs=(), hier_outputs=(), hier_inputs=()):
+    """Net entry in the format written by record_core"""
+    return {
+        "PARENT": parent,
+        "DRIVER": driver,
+        "LEAF.0": {"OUTPUTS": list(hier_outputs), "INPUTS": list(hier_inputs)},
+        "LEAF.1": {"OUTPUTS": list(leaf_outputs), "INPUTS": list(leaf_inputs)},
+    }
+
+
+def make_specimen(inits=("1'b0", "1'b0"), eqn="O6=(A1*A2)", bits=3):
+    """
+    Hierarchical specimen: an accumulator "u0" chaining one adder per
+    flip flop init value.  Each adder is a chain of bits LUT6 -> FDRE
+    stages whose flip flop feeds back into its own LUT.
+    """
+    cells = {"u0": make_cell("", "acc", False, {"c_width": str(len(inits))})}
+    nets = {}
+    previous = "u0/D"
+    for i, init in enumerate(inits):
+        adder = f"u0/a{i}"
+        cells[adder] = make_cell("u0", "adder", False)
+        for j in range(bits):
+            cells[f"{adder}/lut{j}"] = make_cell(adder, "LUT6", True, {"CONFIG.EQN": eqn})
+            cells[f"{adder}/ff{j}"] = make_cell(adder, "FDRE", True, {"CONFIG.INIT": init})
+        cells[f"{adder}/VCC"] = make_cell(adder, "VCC", True)
+        nets[f"{adder}/d"] = make_net(adder, f"{adder}/D", leaf_inputs=[f"{adder}/lut0/A1"])
+        nets[f"{adder}/ce"] = make_net(
+            adder,
+            f"{adder}/VCC/P",
+            [f"{adder}/VCC/P"],
+            [f"{adder}/ff{j}/CE" for j in range(bits)],
+        )
+        for j in range(bits):
+            nets[f"{adder}/n{j}"] = make_net(
+                adder, f"{adder}/lut{j}/O6", [f"{adder}/lut{j}/O6"], [f"{adder}/ff{j}/D"]
+            )
+            q = f"{adder}/ff{j}/Q"
+            if j + 1 < bits:
+                nets[f"{adder}/q{j}"] = make_net(
+                    adder, q, [q], [f"{adder}/lut{j}/A2", f"{adder}/lut{j + 1}/A1"]
+                )
+            else:
+                nets[f"{adder}/q{j}"] = make_net(
+                    adder, q, [q], [f"{adder}/lut{j}/A2"], hier_outputs=[f"{adder}/Q"]
+                )
+        nets[f"u0/s{i}"] = make_net(
+            "u0", previous, hier_outputs=[previous], hier_inputs=[f"{adder}/D"]
+        )
+        previous = f"{adder}/Q"
+    nets["u0/q"] = make_net("u0", previous, hier_outputs=[previous, "u0/Q"])
+    return {"CELLS": cells, "NETS": nets}
+
+
+def make_flat_design(inits=("1'b0", "1'b0"), eqn="O6=(A1*A2)", bits=3):
+    """
+    Flat design, in the format written by record_flat_core, holding the
+    accumulator of make_specimen between an input and an output register.
+    """
+    cells = {}
+
+    def add_cell(name, cell_name, ref, properties=None):
+        cells[name] = make_cell("", ref, True, properties)
+        cells[name]["CELL_NAME"] = cell_name
+
+    add_cell("SLICE_X0Y0.AFF", "in_reg", "FDRE", {"CONFIG.INIT": "1'b0"})
+    add_cell("SLICE_X0Y1.AFF", "out_reg", "FDRE", {"CONFIG.INIT": "1'b0"})
+    nets = []
+    previous = ["SLICE_X0Y0.AFF/Q"]
+    for i, init in enumerate(inits):
+        adder = f"top/u0/a{i}"
+        vcc = f"{adder}/VCC"
+        add_cell(vcc, vcc, "VCC")
+        ce = []
+        for j in range(bits):
+            lut, ff = f"SLICE_X{i + 1}Y{j}.A6LUT", f"SLICE_X{i + 1}Y{j}.AFF"
+            add_cell(lut, f"{adder}/lut{j}", "LUT6", {"CONFIG.EQN": eqn})
+            add_cell(ff, f"{adder}/ff{j}", "FDRE", {"CONFIG.INIT": init})
+            nets.append(previous + [f"{lut}/A1"])
+            nets.append([f"{lut}/O6", f"{ff}/D"])
+            ce.append(f"{ff}/CE")
+            previous = [f"{ff}/Q", f"{lut}/A2"]
+        nets.append([f"{vcc}/P"] + ce)
+    nets.append(previous + ["SLICE_X0Y1.AFF/D"])
+    return {
+        "CELLS": cells,
+        "NETS": {
+            str(i): make_net("", "FLAT_DESIGN", hier_outputs=pins[:1], hier_inputs=pins[1:])
+            for i, pins in enumerate(nets)
+        },
+    }
+
+
+def make_fanout_design(copies=2):
+    """
+    Flat design of copies of a flip flop driving pin A1 of two LUTs, a
+    buffer and an inverter, each into a flip flop of its own.  The LUTs are
+    listed in a different order in every other copy.
+    """
+    cells = {}
+    nets = []
+    for i in range(copies):
+        src = f"SLICE_X{i}Y0.AFF"
+        cells[src] = make_cell("", "FDRE", True, {"CONFIG.INIT": "1'b0"})
+        sinks = []
+        for j, eqn in enumerate(["O6=(A1)", "O6=(~A1)"]):
+            lut, ff = f"SLICE_X{i}Y{j + 1}.A6LUT", f"SLICE_X{i}Y{j + 1}.AFF"
+            cells[lut] = make_cell("", "LUT6", True, {"CONFIG.EQN": eqn})
+            cells[ff] = make_cell("", "FDRE", True, {"CONFIG.INIT": "1'b0"})
+            sinks.append(f"{lut}/A1")
+            nets.append([f"{lut}/O6", f"{ff}/D"])
+        nets.append([f"{src}/Q"] + (sinks if i % 2 == 0 else sinks[::-1]))
+    for name, cell in cells.items():
+        cell["CELL_NAME"] = name
+    return {
+        "CELLS": cells,
+        "NETS": {
+            str(i): make_net("", "FLAT_DESIGN", hier_outputs=pins[:1], hier_inputs=pins[1:])
+            for i, pins in enumerate(nets)
+        },
+    }
+
+
+def make_library_generator(lib_dir=None):
+    """LibraryGenerator without the vivado export, optionally writing to lib_dir"""
+    lib_gen = LibraryGenerator.__new__(LibraryGenerator)
+    if lib_dir is not None:
+        lib_gen.ip = "acc"
+        lib_gen.lib_dir = Path(lib_dir)
+        lib_gen.templ_dir = lib_gen.lib_dir / "templates"
+        lib_gen.graphs_dir = lib_gen.lib_dir / "graphs"
+        lib_gen.templ_dir.mkdir(parents=True, exist_ok=True)
+        lib_gen.graphs_dir.mkdir(parents=True, exist_ok=True)
+    return lib_gen
+
+
+def make_library(lib_dir, specimens):
+    """Build the template library of the given specimen designs in lib_dir"""
+    lib_gen = make_library_generator(lib_dir)
+    templates = {}
+    for specimen in specimens:
+        lib_gen.create_templates(import_design_refactor(specimen, flat=False), templates)
+    lib_gen.init_templates()
+    return Path(lib_dir) / PACKED_LIB_NAME
+
+
+def make_ip_search(lib_file):
+    """IP_Search over a packed library, without importing or searching a design"""
+    ip_search = IP_Search.__new__(IP_Search)
+    ip_search.pool = None
+    ip_search.sent_state = None
+    ip_search.seeds = None
+    ip_search.signatures = None
+    ip_search.library_seeds = None
+    ip_search.domain_sizes = {}
+    ip_search.span_backends = {}
+    ip_search.library = PackedLibrary(lib_file)
+    ip_search.templates = ip_search.library.templates
+    ip_search.used_list = ip_search.library.used
+    ip_search.template_cache = TemplateCache(ip_search.decode_template)
+    ip_search.failure_cache = FailureCache()
+    ip_search.descend_failures = FailureCache()
+    ip_search.descend_radii = {}
+    return ip_search
+
+
 class TestCompareV(unittest.TestCase):
     """
     Functions for testing compare_v.py
@@ -136,6 +341,113 @@ class TestCompareV(unittest.TestCase):
     def test_compare_vertex(self):
         pass
 
+    def test_compare_vertex_refactor(self):
+        """
+        Test compare_v_refactor.compare_vertex against compare_v.compare_vertex
+        """
+        for inits in [("1'b0", "1'b0"), ("1'b0", "1'b1", "1'b0")]:
+            g = import_design_refactor(make_flat_design(inits), flat=True)
+            g_hier = import_design_refactor(make_specimen(inits), flat=False)
+            for v in g.vs:
+                for v2 in g_hier.vs.select(ref=v["ref"]):
+                    mapping = {v.index: v2.index}
+                    expected = compare_vertex(dict(mapping), g, v, g_hier, v2, 0, 0)
+                    actual = compare_vertex_refactor(mapping, g, v, g_hier, v2)
+                    self.assertEqual(actual, expected or False)
+                    if not actual:
+                        self.assertEqual(mapping, {v.index: v2.index})
+
+        # Regions far larger than the recursion limit
+        g = import_design_refactor(make_flat_design(("1'b0",), bits=1000), flat=True)
+        mapping = compare_vertex_refactor({0: 0}, g, g.vs[0], g, g.vs[0])
+        self.assertEqual(mapping, {x: x for x in range(g.vcount())})
+
+    def test_index_edges(self):
+        g = import_design_refactor(make_specimen(), flat=False)
+        index_edges(g)
+        for v in g.vs:
+            self.assertEqual(v["in_adj"], vertex_adjacency(v, "in"))
+            self.assertEqual(v["out_adj"], vertex_adjacency(v, "out"))
+        # One group per input pin of the next stages, with the same labels in every adder
+        v = g.vs.find(name="u0/a0/ff1")
+        self.assertEqual(
+            [[g.vs[x]["name"] for x in neighbors] for _, neighbors in v["out_adj"]],
+            [["u0/a0/lut1"], ["u0/a0/lut2"]],
+        )
+        self.assertEqual(
+            [label for label, _ in g.vs.find(name="u0/a1/ff1")["out_adj"]],
+            [label for label, _ in v["out_adj"]],
+        )
+
+    def test_signature_index(self):
+        """Signatures never rule out a pair of vertices that compare_vertex matches"""
+        g = import_design_refactor(make_flat_design(("1'b0", "1'b1", "1'b0")), flat=True)
+        g_hier = import_design_refactor(make_specimen(("1'b0", "1'b1", "1'b0")), flat=False)
+        index_edges(g)
+        index_edges(g_hier)
+        signatures, hier_signatures = SignatureIndex(g), SignatureIndex(g_hier)
+        rejected = 0
+        for v in g.vs:
+            for w in g_hier.vs.select(ref=v["ref"]):
+                contained = signatures.contains(v.index, hier_signatures[w.index])
+                if compare_vertex_refactor({v.index: w.index}, g, v, g_hier, w):
+                    self.assertTrue(contained, (v.index, w.index))
+                rejected += not contained
+        self.assertTrue(rejected)
+
+    def test_compare_ref_refactor(self):
+        """The property fingerprints agree with comparing the properties one by one"""
+        g = Graph(directed=True)
+        properties = [
+            {"INIT": "1'b0", "IS_C_INVERTED": "1'b0"},
+            {"INIT": "1'b0", "IS_C_INVERTED": "1'b0"},
+            {"INIT": "1'b1", "IS_C_INVERTED": "1'b0"},
+            {"INIT": "1'b0"},
+            {"INIT": "1'b1"},
+            {"INIT": "1'b0", "IS_C_INVERTED": "1'b0", "SRVAL": "1'b1"},
+        ]
+        g.add_vertices(len(properties))
+        g.vs["ref"] = "FDRE"
+        g.vs["IS_PRIMITIVE"] = True
+        g.vs["CONFIG.EQN"] = ""
+        g.vs["EQN_PIN_DICT"] = [{} for x in properties]
+        g.vs["BEL_PROPERTIES"] = properties
+        for v1 in g.vs:
+            for v2 in g.vs:
+                props1, props2 = v1["BEL_PROPERTIES"], v2["BEL_PROPERTIES"]
+                expected = all(props1[x] == props2[x] for x in props1.keys() & props2.keys())
+                self.assertEqual(compare_ref_refactor(v1, v2), expected, (v1.index, v2.index))
+
+        # Parametric template properties allow any of their values
+        g.vs[0]["PARAM_PROPERTIES"] = {"INIT": ["1'b0", "1'b1"]}
+        self.assertTrue(compare_ref_refactor(g.vs[2], g.vs[0]))
+        self.assertFalse(compare_ref_refactor(g.vs[0], g.vs[2]))
+
+    def test_vertex_mapping(self):
+        mapping = VertexMapping({1: 10, 2: 20})
+        mapping[3] = 30
+        mapping[1] = 11
+        self.assertEqual(mapping.inverse, {11: 1, 20: 2, 30: 3})
+        self.assertIn(20, mapping.values())
+        self.assertNotIn(10, mapping.values())
+        with self.assertRaises(ValueError):
+            mapping[4] = 20
+        self.assertEqual(mapping.pop(2), 20)
+        self.assertEqual(mapping.pop(2, None), None)
+        self.assertEqual(mapping.inverse, {11: 1, 30: 3})
+
+        copy = mapping.copy()
+        copy[5] = 50
+        self.assertNotIn(50, mapping.values())
+        self.assertEqual(copy.inverse, {11: 1, 30: 3, 50: 5})
+        self.assertEqual(copy.added_since(len(mapping)), [50])
+
+        # Pickles as a dict, and plain dicts (older checkpoints) load into it
+        for data in (pickle.dumps(copy), pickle.dumps(dict(copy))):
+            loaded = VertexMapping(pickle.loads(data))
+            self.assertEqual(loaded, {1: 11, 3: 30, 5: 50})
+            self.assertEqual(loaded.inverse, copy.inverse)
+
     def test_print_graph_refactor(self):
         """
         Test compare_v_refactor.print_graph against compare_v.print_graph
@@ -159,5 +471,747 @@ class TestCompareV(unittest.TestCase):
                 )
 
 
+class TestCreateLib(unittest.TestCase):
+    """
+    Functions for testing create_lib.py
+    """
+
+    def test_get_module_subgraph(self):
+        g = import_design_refactor(make_specimen(bits=2), flat=False)
+        lib_gen = make_library_generator()
+        design_index = lib_gen.index_design(g)
+
+        g_sub = lib_gen.get_module_subgraph(g, "u0/a1", design_index)
+        self.assertEqual(g_sub.vs["name"], ["a1", "lut0", "ff0", "lut1", "ff1", "VCC"])
+        self.assertEqual(g_sub.vs["id"], [0, 1, 2, 3, 4, 5])
+        self.assertEqual(set(g_sub.vs["parent"][1:]), {"a1"})
+        self.assertEqual(set(g_sub.es["parent"]), {"a1"})
+        self.assertEqual(
+            sorted((e.source, e.target, e["in_pin"], e["out_pin"]) for e in g_sub.es),
+            [
+                (0, 1, "A1", "D"),
+                (1, 2, "D", "O6"),
+                (2, 1, "A2", "Q"),
+                (2, 3, "A1", "Q"),
+                (3, 4, "D", "O6"),
+                (4, 0, "Q", "Q"),
+                (4, 3, "A2", "Q"),
+                (5, 2, "CE", "P"),
+                (5, 4, "CE", "P"),
+            ],
+        )
+        self.assertEqual(
+            g_sub.vs[2]["BEL_PROPERTIES"], g.vs.find(name="u0/a1/ff0")["BEL_PROPERTIES"]
+        )
+
+        g_top = lib_gen.get_module_subgraph(g, "u0")
+        self.assertEqual(g_top.vs["name"], ["u0", "a0", "a1"])
+        self.assertEqual(len(g_top.es), 3)
+        self.assertIsNone(lib_gen.get_module_subgraph(g, "u1", design_index))
+
+    def test_search_metadata(self):
+        with tempfile.TemporaryDirectory() as lib_dir:
+            with PackedLibrary(make_library(lib_dir, [make_specimen()])) as library:
+                (ver,) = library.templates["adder"]
+                entry = library.templates["adder"][ver]
+                self.assertEqual(entry["ports"], {"in": ["D"], "out": ["Q"]})
+                self.assertNotIn("search", entry["blobs"])
+                (span,) = entry["span"]
+                self.assertEqual(span["size"], 6)
+                self.assertEqual(span["ref_histogram"], {"LUT6": 3, "FDRE": 3})
+                # Equally rare refs, so a flip flop driving two luts is picked
+                g_template = library.load("adder", ver)
+                self.assertEqual(g_template.vs[span["anchor"]]["ref"], "FDRE")
+                search_data = make_library_generator().get_search_metadata(g_template)
+                self.assertEqual(search_data["degree"][span["anchor"]], [2, 2])
+                self.assertEqual(search_data["degree"][:3], [[0, 0], [1, 1], [2, 2]])
+
+    def test_parametric_versions(self):
+        with tempfile.TemporaryDirectory() as lib_dir:
+            lib_file = make_library(lib_dir, [make_specimen(("1'b0", "1'b1"))])
+            self.assertEqual(len(list((Path(lib_dir) / "templates" / "adder").iterdir())), 2)
+            with PackedLibrary(lib_file) as library:
+                (ver,) = library.templates["adder"]
+                self.assertEqual(library.templates["adder"][ver]["members"], ["0.pkl", "1.pkl"])
+                g_template = library.load("adder", ver, "projection")
+                v_ff = g_template.vs.find(name="ff0")
+                self.assertEqual(v_ff["PARAM_PROPERTIES"], {"CONFIG.INIT": ["1'b0", "1'b1"]})
+                self.assertIsNone(v_ff["PARAM_EQN"])
+                self.assertIsNone(g_template.vs.find(name="lut0")["PARAM_PROPERTIES"])
+
+                g = import_design_refactor(make_flat_design(), flat=True)
+                for init in ["1'b0", "1'b1"]:
+                    v_design = g.vs.find(CELL_NAME="top/u0/a0/ff0")
+                    v_design["BEL_PROPERTIES"] = {"CONFIG.INIT": init}
+                    self.assertTrue(compare_ref(v_design, v_ff))
+                v_design["BEL_PROPERTIES"] = {"CONFIG.INIT": "1'bx"}
+                self.assertFalse(compare_ref(v_design, v_ff))
+
+        # A property only one version has is not required of the other's matches
+        specimen = make_specimen(("1'b0", "1'b1"))
+        specimen["CELLS"]["u0/a0/ff0"]["BEL_PROPERTIES"]["CONFIG.IS_C_INVERTED"] = "1'b1"
+        with tempfile.TemporaryDirectory() as lib_dir:
+            with PackedLibrary(make_library(lib_dir, [specimen])) as library:
+                versions = library.templates["adder"]
+                members = sorted(x["members"] for x in versions.values())
+                self.assertEqual(members, [["0.pkl"], ["1.pkl"]])
+                v_design = import_design_refactor(make_flat_design(), flat=True).vs[0]
+                v_design["BEL_PROPERTIES"] = {"CONFIG.INIT": "1'b1", "CONFIG.IS_C_INVERTED": "1'b0"}
+                matched = [
+                    compare_ref(v_design, library.load("adder", ver).vs.find(name="ff0"))
+                    for ver in versions
+                ]
+                self.assertEqual(sorted(matched), [False, True])
+
+
+class TestPackedLib(unittest.TestCase):
+    """
+    Functions for testing packed_lib.py
+    """
+
+    def test_pack_graph(self):
+        g = import_design_refactor(make_specimen(), flat=False)
+        g["span"] = [[1, 2]]
+        g_unpacked = unpack_graph(pack_graph(g))
+        self.assertEqual(g_unpacked.get_edgelist(), g.get_edgelist())
+        self.assertEqual(g_unpacked["span"], [[1, 2]])
+        for attr in g.vs.attributes():
+            self.assertEqual(g_unpacked.vs[attr], g.vs[attr])
+        for attr in g.es.attributes():
+            self.assertEqual(g_unpacked.es[attr], g.es[attr])
+
+    def test_packed_library(self):
+        with tempfile.TemporaryDirectory() as lib_dir:
+            lib_file = make_library(lib_dir, [make_specimen(), make_specimen(("1'b1", "1'b0"))])
+            with PackedLibrary(lib_file) as library:
+                self.assertEqual(sorted(library.templates), ["acc", "adder"])
+                # The two adder versions only differ in flip flop init values
+                self.assertEqual(len(library.templates["adder"]), 1)
+                self.assertEqual(len(library.templates["adder"]["0.pkl"]["members"]), 2)
+                self.assertEqual(library.used, {"adder": ["acc"]})
+                for ref, versions in library.templates.items():
+                    for ver, entry in versions.items():
+                        g = library.load(ref, ver)
+                        g_file = Graph.Read_Pickle(str(Path(lib_dir) / "templates" / ref / ver))
+                        self.assertEqual(g.get_edgelist(), g_file.get_edgelist())
+                        self.assertEqual(g.vs["name"], g_file.vs["name"])
+                        self.assertEqual(entry["primitive_count"], g["primitive_count"])
+
+
+class TestSearchLib(unittest.TestCase):
+    """
+    Functions for testing search_lib_refactor.py
+    """
+
+    def test_load_template(self):
+        with tempfile.TemporaryDirectory() as lib_dir:
+            ip_search = make_ip_search(make_library(lib_dir, [make_specimen()]))
+            (ver,) = ip_search.templates["adder"]
+            g_projection = ip_search.load_template("adder", ver)
+            g_full = ip_search.load_template("adder", ver, full=True)
+            self.assertEqual(g_projection.get_edgelist(), g_full.get_edgelist())
+            self.assertEqual(g_projection.attributes(), [])
+            self.assertNotIn("CELL_PROPERTIES", g_projection.vs.attributes())
+            self.assertNotIn("parent", g_projection.vs.attributes())
+            self.assertEqual(set(g_projection.es.attributes()), {"in_pin", "out_pin", "signal"})
+            for attr in g_projection.vs.attributes():
+                self.assertEqual(g_projection.vs[attr], g_full.vs[attr])
+            self.assertIn("user_properties", g_full.attributes())
+            ip_search.library.close()
+
+    def test_template_cache(self):
+        with tempfile.TemporaryDirectory() as lib_dir:
+            with PackedLibrary(make_library(lib_dir, [make_specimen()])) as library:
+                (ver,) = library.templates["adder"]
+                g_adder = library.load("adder", ver)
+                cache = TemplateCache(library.load)
+                g = cache.get("adder", ver)
+                g.vs[1]["ref"] = "LUT5"
+                g.add_vertices(1)
+                self.assertEqual(cache.get("adder", ver).vs["ref"], g_adder.vs["ref"])
+                self.assertEqual((cache.hits, cache.misses), (1, 1))
+                self.assertEqual(cache.size, g_adder.vcount() + g_adder.ecount())
+
+                # Only the most recently used template fits
+                cache = TemplateCache(library.load, max_size=g_adder.vcount() + g_adder.ecount())
+                cache.get("adder", ver)
+                cache.get("acc", ver)
+                cache.get("adder", ver)
+                self.assertEqual((cache.hits, cache.misses), (0, 3))
+                self.assertEqual(list(cache.graphs), [("adder", ver)])
+
+    def test_search(self):
+        with tempfile.TemporaryDirectory() as lib_dir:
+            ip_search = make_ip_search(make_library(lib_dir, [make_specimen()]))
+            g = ip_search.label_const_sources(import_design_refactor(make_flat_design(), flat=True))
+            g_template, mapping = ip_search.search(g)
+            self.assertIsNone(ip_search.pool)
+            self.assertEqual(set(ip_search.span_backends.values()), {"python"})
+            self.assertEqual(
+                sorted(g.vs[x]["CELL_NAME"] for x in mapping),
+                sorted(x for x in g.vs["CELL_NAME"] if x.startswith("top/u0/")),
+            )
+            names = ip_search.get_names(g_template)
+            for x, y in mapping.items():
+                self.assertEqual(names[y].split("/")[-1], g.vs[x]["CELL_NAME"].split("/")[-1])
+            for v in g_template.vs:
+                self.assertEqual(v["in_adj"], vertex_adjacency(v, "in"))
+                self.assertEqual(v["out_adj"], vertex_adjacency(v, "out"))
+            g_rebuilt = ip_search.rebuild_template(g_template["ops"])
+            self.assertEqual(g_rebuilt.get_edgelist(), g_template.get_edgelist())
+            self.assertEqual(g_rebuilt.vs["name"], g_template.vs["name"])
+            ip_search.library.close()
+
+    def test_search_backends(self):
+        """Spans are matched by compare_vertex_batch, with LAD only retrying its misses"""
+        results = {}
+        for lad in (False, True):
+            with tempfile.TemporaryDirectory() as lib_dir:
+                ip_search = make_ip_search(make_library(lib_dir, [make_specimen()]))
+                g = import_design_refactor(make_flat_design(), flat=True)
+                g = ip_search.label_const_sources(g)
+                with mock.patch("search_lib_refactor.LAD_BACKEND", lad), mock.patch.object(
+                    LadMatcher, "qualifies", return_value=True
+                ), mock.patch(
+                    "search_lib_refactor.compare_vertex_batch", wraps=compare_vertex_batch
+                ) as batch:
+                    _, mapping = ip_search.search(g)
+                self.assertTrue(batch.called)
+                backends = set(ip_search.span_backends.values())
+                self.assertEqual(backends, {"lad" if lad else "python"})
+                results[lad] = sorted(mapping.items())
+                ip_search.library.close()
+        self.assertTrue(results[False])
+        self.assertEqual(results[False], results[True])
+
+    def test_skip_covered_seeds(self):
+        """Seeds inside a found match are only searched from when overlaps are wanted"""
+        results = {}
+        for overlapping in (False, True):
+            with tempfile.TemporaryDirectory() as lib_dir:
+                ip_search = make_ip_search(make_library(lib_dir, [make_specimen()]))
+                g = import_design_refactor(make_flat_design(), flat=True)
+                g = ip_search.label_const_sources(g)
+                seeds = []
+                run_replace_greedy = ip_search.run_replace_greedy
+
+                def count_seeds(g, g_template, mapping, depth):
+                    seeds.append(dict(mapping))
+                    return run_replace_greedy(g, g_template, mapping, depth)
+
+                ip_search.run_replace_greedy = count_seeds
+                with mock.patch("search_lib_refactor.FIND_OVERLAPPING", overlapping):
+                    _, mapping = ip_search.search(g)
+                results[overlapping] = (len(seeds), sorted(mapping.items()))
+                ip_search.library.close()
+        self.assertLess(results[False][0], results[True][0])
+        self.assertEqual(results[False][1], results[True][1])
+
+    def test_span_fits(self):
+        """Templates are not loaded for designs with fewer cells of a ref than their spans"""
+        with tempfile.TemporaryDirectory() as lib_dir:
+            ip_search = make_ip_search(make_library(lib_dir, [make_specimen()]))
+            for bits, fits in ((3, True), (2, False)):
+                g = import_design_refactor(make_flat_design(("1'b0",), bits=bits), flat=True)
+                g = ip_search.label_const_sources(g)
+                with mock.patch.object(
+                    ip_search, "load_template", wraps=ip_search.load_template
+                ) as load_template:
+                    _, mapping = ip_search.search(g)
+                (span,) = next(iter(ip_search.templates["adder"].values()))["span"]
+                self.assertEqual(ip_search.span_fits(span), fits)
+                self.assertEqual(bool(mapping), fits)
+                loaded = {args[0] for args, _ in load_template.call_args_list}
+                self.assertEqual("adder" in loaded, fits)
+            ip_search.library.close()
+
+    def test_seed_batches(self):
+        """Seeds covered by a match of an earlier batch are not matched again"""
+        results = {}
+        for size in (1, 1000):
+            with tempfile.TemporaryDirectory() as lib_dir:
+                ip_search = make_ip_search(make_library(lib_dir, [make_specimen()]))
+                g = import_design_refactor(make_flat_design(), flat=True)
+                g = ip_search.label_const_sources(g)
+                with mock.patch("search_lib_refactor.SEED_BATCH_SIZE", size), mock.patch(
+                    "search_lib_refactor.compare_vertex_batch", wraps=compare_vertex_batch
+                ) as batch:
+                    _, mapping = ip_search.search(g)
+                seeds = sum(len(args[1]) for args, _ in batch.call_args_list)
+                results[size] = (seeds, sorted(mapping.items()))
+                ip_search.library.close()
+        self.assertLess(results[1][0], results[1000][0])
+        self.assertEqual(results[1][1], results[1000][1])
+
+    def test_rank_seeds(self):
+        with tempfile.TemporaryDirectory() as lib_dir:
+            ip_search = make_ip_search(make_library(lib_dir, [make_specimen()]))
+            g = ip_search.label_const_sources(import_design_refactor(make_flat_design(), flat=True))
+            ip_search.seeds = ip_search.index_seeds(g)
+            ip_search.signatures = SignatureIndex(g)
+            (ver,) = ip_search.templates["adder"]
+            g_template = ip_search.start_template("adder", ver)
+            (span,) = ip_search.templates["adder"][ver]["span"]
+            v2_id = ip_search.get_span_anchor(g_template, span)
+            # The design has fewer luts than flip flops
+            self.assertEqual(g_template.vs[v2_id]["ref"], "LUT6")
+            # Among equally rare refs, the anchor picked from the library
+            seeds = ip_search.seeds
+            ip_search.seeds = {ref: seeds["LUT6"] for ref in seeds}
+            self.assertEqual(ip_search.get_span_anchor(g_template, span), span["anchor"])
+            ip_search.seeds = seeds
+            for v2 in g_template.vs.select(span["indices"]):
+                ranked = ip_search.rank_seeds(g, g_template, v2.index)
+                matched = [
+                    v.index
+                    for v in g.vs.select(ref=v2["ref"])
+                    if compare_vertex_refactor({v.index: v2.index}, g, v, g_template, v2)
+                ]
+                self.assertTrue(set(matched).issubset(ranked))
+                self.assertEqual(len(ranked), len(set(ranked)))
+            ip_search.library.close()
+
+    def test_library_seeds(self):
+        """The inverted library index finds the seeds rank_seeds finds for each span"""
+        with tempfile.TemporaryDirectory() as lib_dir:
+            ip_search = make_ip_search(make_library(lib_dir, [make_specimen()]))
+            g = ip_search.label_const_sources(import_design_refactor(make_flat_design(), flat=True))
+            index_edges(g)
+            ip_search.seeds = ip_search.index_seeds(g)
+            ip_search.signatures = SignatureIndex(g)
+            library_seeds = ip_search.index_library_seeds(g)
+            spans = 0
+            for ref, versions in ip_search.templates.items():
+                for ver, entry in versions.items():
+                    g_template = ip_search.load_template(ref, ver)
+                    for i, span in enumerate(entry["span"]):
+                        if ip_search.skip_span(g_template, span):
+                            self.assertNotIn((ref, ver, i), library_seeds)
+                            continue
+                        v2_id = ip_search.get_span_anchor(g_template, span)
+                        self.assertEqual(
+                            library_seeds[(ref, ver, i)],
+                            ip_search.rank_seeds(g, g_template, v2_id),
+                        )
+                        spans += 1
+            self.assertEqual(spans, len(library_seeds))
+            (ver,) = ip_search.templates["adder"]
+            self.assertTrue(library_seeds[("adder", ver, 0)])
+            ip_search.library.close()
+
+    def test_library_seed_groups(self):
+        """Versions whose anchors have the same structure share one group of seeds"""
+        with tempfile.TemporaryDirectory() as lib_dir:
+            specimens = [make_specimen(), make_specimen(bits=4)]
+            ip_search = make_ip_search(make_library(lib_dir, specimens))
+            g = ip_search.label_const_sources(import_design_refactor(make_flat_design(), flat=True))
+            index_edges(g)
+            ip_search.seeds = ip_search.index_seeds(g)
+            ip_search.signatures = SignatureIndex(g)
+            library_seeds = ip_search.index_library_seeds(g)
+            ver0, ver1 = sorted(ip_search.templates["adder"])
+            self.assertTrue(library_seeds[("adder", ver0, 0)])
+            self.assertIs(library_seeds[("adder", ver0, 0)], library_seeds[("adder", ver1, 0)])
+            ip_search.library.close()
+
+    def test_span_domains(self):
+        """Every match compare_vertex finds stays within the refined domains"""
+        with tempfile.TemporaryDirectory() as lib_dir:
+            ip_search = make_ip_search(make_library(lib_dir, [make_specimen()]))
+            g = ip_search.label_const_sources(import_design_refactor(make_flat_design(), flat=True))
+            index_edges(g)
+            ip_search.seeds = ip_search.index_seeds(g)
+            ip_search.signatures = SignatureIndex(g)
+            (ver,) = ip_search.templates["adder"]
+            g_template = ip_search.start_template("adder", ver)
+            (span,) = ip_search.templates["adder"][ver]["span"]
+            matches = 0
+            for v2 in g_template.vs.select(span["indices"]):
+                domains = ip_search.span_domains(g, g_template, v2.index)
+                self.assertTrue(set(span["indices"]).issubset(domains))
+                for v in g.vs.select(ref=v2["ref"]):
+                    mapping = compare_vertex_refactor({v.index: v2.index}, g, v, g_template, v2)
+                    if not mapping:
+                        continue
+                    for x, y in mapping.items():
+                        self.assertIn(x, domains[y])
+                    matches += 1
+                    self.assertEqual(
+                        compare_vertex_refactor(
+                            {v.index: v2.index}, g, v, g_template, v2, domains
+                        ),
+                        mapping,
+                    )
+                # Chain ends and the registers around the adders are pruned
+                if v2["ref"] != "VCC":
+                    self.assertLess(len(domains[v2.index]), len(g.vs.select(ref=v2["ref"])))
+            self.assertTrue(matches)
+            ip_search.library.close()
+
+    def test_failure_cache(self):
+        """Pairs are looked up in the failure cache, with the same results as without it"""
+        with tempfile.TemporaryDirectory() as lib_dir:
+            ip_search = make_ip_search(make_library(lib_dir, [make_specimen()]))
+            g = ip_search.label_const_sources(import_design_refactor(make_flat_design(), flat=True))
+            (ver,) = ip_search.templates["adder"]
+            g_template = ip_search.start_template("adder", ver)
+            self.assertEqual(g_template.vs[3]["origin"], ("adder", ver, 3))
+
+            def compare_twice(failures):
+                for _ in range(2):
+                    for v in g.vs:
+                        for w in g_template.vs:
+                            self.assertEqual(
+                                compare_vertex_refactor(
+                                    {v.index: w.index}, g, v, g_template, w, failures=failures
+                                ),
+                                compare_vertex_refactor({v.index: w.index}, g, v, g_template, w),
+                            )
+                return failures
+
+            self.assertTrue(compare_twice(FailureCache()).hits)
+            self.assertEqual(len(compare_twice(FailureCache(max_size=4)).failed), 4)
+            ip_search.library.close()
+
+    def test_compare_vertex_batch(self):
+        """compare_vertex_batch gives the mappings compare_vertex finds seed by seed"""
+        for inits in [("1'b0", "1'b0"), ("1'b0", "1'b1", "1'b0")]:
+            with tempfile.TemporaryDirectory() as lib_dir:
+                ip_search = make_ip_search(make_library(lib_dir, [make_specimen(inits)]))
+                g = import_design_refactor(make_flat_design(inits), flat=True)
+                g = ip_search.label_const_sources(g)
+                g_hier = import_design_refactor(make_specimen(inits), flat=False)
+                (ver,) = ip_search.templates["adder"]
+                g_template = ip_search.start_template("adder", ver)
+                seeds = list(range(g.vcount()))
+                matches = 0
+                for g_rh in (g_hier, g_template):
+                    for w in g_rh.vs:
+                        expected = [
+                            compare_vertex_refactor({v.index: w.index}, g, v, g_rh, w)
+                            for v in g.vs
+                        ]
+                        self.assertEqual(compare_vertex_batch(g, seeds, g_rh, w.index), expected)
+                        matches += sum(1 for x in expected if x and len(x) > 1)
+                self.assertTrue(matches)
+                ip_search.library.close()
+
+    def test_compare_vertex_batch_fanout(self):
+        """Only the seeds past the unambiguous edges reach compare_vertex"""
+        g = import_design_refactor(make_fanout_design(), flat=True)
+        g_template = import_design_refactor(make_fanout_design(1), flat=True)
+        index_edges(g)
+        index_edges(g_template)
+        seeds = list(range(g.vcount()))
+        for w in g_template.vs:
+            expected = [
+                compare_vertex_refactor({v.index: w.index}, g, v, g_template, w) for v in g.vs
+            ]
+            with mock.patch(
+                "compare_v_refactor.compare_vertex", wraps=compare_vertex_refactor
+            ) as scalar:
+                self.assertEqual(compare_vertex_batch(g, seeds, g_template, w.index), expected)
+            self.assertEqual(sum(1 for x in expected if x), 2)
+            if w.outdegree() > 1:
+                # Every edge of the flip flop fanning out is ambiguous
+                self.assertEqual(scalar.call_count, len(g.vs.select(ref=w["ref"])))
+            else:
+                # One match per copy, the other seeds fail before the fanout
+                self.assertEqual(scalar.call_count, 2)
+
+    def test_lad_matcher(self):
+        """LadMatcher agrees with compare_vertex on the spans of the adder"""
+        for inits in [("1'b0", "1'b0"), ("1'b0", "1'b1", "1'b0")]:
+            with tempfile.TemporaryDirectory() as lib_dir:
+                ip_search = make_ip_search(make_library(lib_dir, [make_specimen(inits)]))
+                g = import_design_refactor(make_flat_design(inits), flat=True)
+                g = ip_search.label_const_sources(g)
+                index_edges(g)
+                ip_search.seeds = ip_search.index_seeds(g)
+                ip_search.signatures = SignatureIndex(g)
+                (ver,) = ip_search.templates["adder"]
+                g_template = ip_search.start_template("adder", ver)
+                (span,) = ip_search.templates["adder"][ver]["span"]
+                matches = 0
+                for v2 in g_template.vs.select(span["indices"]):
+                    domains = ip_search.span_domains(g, g_template, v2.index)
+                    region = list(domains)
+                    # Every edge of the adder is matched alone, see LadMatcher.qualifies
+                    self.assertFalse(LadMatcher.qualifies(g_template, region))
+                    matcher = LadMatcher(g, g_template, region, domains)
+                    for v in g.vs.select(ref=v2["ref"]):
+                        expected = compare_vertex_refactor(
+                            {v.index: v2.index}, g, v, g_template, v2, domains
+                        )
+                        self.assertEqual(matcher.match(v.index, v2.index), expected)
+                        matches += bool(expected)
+                self.assertTrue(matches)
+
+                # A second edge with the same pins leaves compare_vertex a choice
+                lut, ff = g_template.vs.find(name="lut0"), g_template.vs.find(name="ff0")
+                e = g_template.es[g_template.get_eid(lut, ff)]
+                g_template.add_edge(lut, g_template.vs.find(name="ff1"), **e.attributes())
+                index_edges(g_template)
+                region = match_region(g_template, lut.index)
+                self.assertTrue(LadMatcher.qualifies(g_template, region))
+                ip_search.library.close()
+
+    def test_lad_matcher_fanout(self):
+        """LadMatcher agrees with compare_vertex where an edge group fans out"""
+        g = import_design_refactor(make_fanout_design(), flat=True)
+        g_template = import_design_refactor(make_fanout_design(1), flat=True)
+        index_edges(g)
+        index_edges(g_template)
+        g_columns, t_columns = get_columns(g), get_columns(g_template)
+        matches = 0
+        for v2 in g_template.vs:
+            region = match_region(g_template, v2.index)
+            self.assertTrue(LadMatcher.qualifies(g_template, region))
+            domains = {
+                x: {v.index for v in g.vs if compare_ref_columns(g_columns, v.index, t_columns, x)}
+                for x in region
+            }
+            domains = refine_domains(g, g_template, domains)
+            matcher = LadMatcher(g, g_template, region, domains)
+            for v in g.vs:
+                expected = compare_vertex_refactor(
+                    {v.index: v2.index}, g, v, g_template, v2, domains
+                )
+                self.assertEqual(matcher.match(v.index, v2.index), expected)
+                matches += bool(expected)
+        # Every vertex of the template matches each copy
+        self.assertEqual(matches, 2 * g_template.vcount())
+
+    def ascend_from_adder(self, ip_search, g):
+        """
+        Working graph of a search seeded on the second adder of the flat
+        design and ascended into the accumulator, with the first adder
+        left to descend into.
+        """
+        (ver,) = ip_search.templates["adder"]
+        g_template = ip_search.start_template("adder", ver)
+        v = g.vs.find(CELL_NAME="top/u0/a1/ff0")
+        v2 = g_template.vs.find(name="ff0")
+        mapping = compare_vertex_refactor({v.index: v2.index}, g, v, g_template, v2)
+        (acc_ver,) = ip_search.templates["acc"]
+        v_top = ip_search.load_template("acc", acc_ver).vs.find(name="a1").index
+        g_template, pass_flag, new_vertices = ip_search.apply_template(
+            g_template, "acc", acc_ver, v_top, "ascend"
+        )
+        self.assertEqual(pass_flag, 1)
+        # The ascend only re-indexes the vertices it touched
+        columns = get_columns(g_template).columns
+        self.assertEqual(columns, GraphColumns(g_template).columns)
+        for v in g_template.vs:
+            self.assertEqual(v["in_adj"], vertex_adjacency(v, "in"))
+            self.assertEqual(v["out_adj"], vertex_adjacency(v, "out"))
+        mapping = ip_search.update_map(g, g_template, mapping, new_vertices, 0)
+        names = ip_search.get_names(g_template)
+        (v_hier,) = [
+            x.index for x in g_template.vs.select(color="green") if names[x.index] == "u0/a0"
+        ]
+        return g_template, mapping, v_hier
+
+    def assertGraphEqual(self, g1, g2):
+        self.assertEqual(g1.get_edgelist(), g2.get_edgelist())
+        self.assertEqual(g1.attributes(), g2.attributes())
+        for attr in g1.attributes():
+            self.assertEqual(g1[attr], g2[attr])
+        for attr in g1.vs.attributes():
+            self.assertEqual(g1.vs[attr], g2.vs[attr])
+        for attr in g1.es.attributes():
+            self.assertEqual(g1.es[attr], g2.es[attr])
+
+    def test_descend_task(self):
+        with tempfile.TemporaryDirectory() as lib_dir:
+            ip_search = make_ip_search(make_library(lib_dir, [make_specimen()]))
+            g = ip_search.label_const_sources(import_design_refactor(make_flat_design(), flat=True))
+            (ver,) = ip_search.templates["adder"]
+            g_template, mapping, v_hier = self.ascend_from_adder(ip_search, g)
+            g_descended, mapping_descended, new_vertices = ip_search.descend_template(
+                g, g_template, mapping, "adder", ver, v_hier
+            )
+            names = ip_search.get_names(g_descended)
+            v_lut = [x for x in new_vertices if g_descended.vs[x]["name"] == "lut0"]
+            self.assertEqual([names[x] for x in v_lut], ["u0/a0/lut0"])
+
+            # Workers rebuild the working graph from its operation log
+            init_worker(ip_search, g)
+            state = SearchState(g_template, mapping, 0)
+            self.assertEqual(descend_task((state, "adder", ver, v_hier)), len(mapping_descended))
+            # and the mapping from its changes to a state they were sent before
+            state = SearchState(g_descended, mapping_descended, 1, (0, mapping))
+            self.assertEqual(len(state.changed), len(mapping_descended) - len(mapping))
+            self.assertEqual(descend_task((state, "adder", ver, v_hier)), 0)
+            state = SearchState(g_template, mapping, 2, (3, mapping_descended))
+            self.assertIsNone(descend_task((state, "adder", ver, v_hier)))
+            g_unlogged = g_template.copy()
+            del g_unlogged["ops"]
+            with self.assertRaises(ValueError):
+                SearchState(g_unlogged, mapping)
+
+            # map_descend sends the whole mapping again to workers that miss the base
+            ip_search.pool = mock.Mock()
+            ip_search.pool.map.side_effect = lambda f, tasks, chunksize: [f(x) for x in tasks]
+            ip_search.sent_state = None
+            for _ in range(2):
+                self.assertEqual(
+                    ip_search.map_descend(g, g_template, mapping, "adder", [ver, ver], v_hier),
+                    [len(mapping_descended)] * 2,
+                )
+            self.assertEqual(ip_search.pool.map.call_count, 2)
+            init_worker(ip_search, g)
+            self.assertEqual(
+                ip_search.map_descend(g, g_template, mapping, "adder", [ver, ver], v_hier),
+                [len(mapping_descended)] * 2,
+            )
+            self.assertEqual(ip_search.pool.map.call_count, 4)
+            ip_search.pool = None
+            ip_search.library.close()
+
+    def test_ascend_loads_once(self):
+        """ascend hands the template it loaded to apply_template"""
+        with tempfile.TemporaryDirectory() as lib_dir:
+            ip_search = make_ip_search(make_library(lib_dir, [make_specimen()]))
+            g = ip_search.label_const_sources(import_design_refactor(make_flat_design(), flat=True))
+            (ver,) = ip_search.templates["adder"]
+            g_template = ip_search.start_template("adder", ver)
+            v = g.vs.find(CELL_NAME="top/u0/a1/ff0")
+            v2 = g_template.vs.find(name="ff0")
+            mapping = compare_vertex_refactor({v.index: v2.index}, g, v, g_template, v2)
+            with mock.patch.object(
+                ip_search, "load_template", wraps=ip_search.load_template
+            ) as load_template:
+                _, _, decisions = ip_search.ascend(g, g_template, mapping)
+            # The adder fits either adder of the accumulator
+            self.assertEqual(len(decisions["acc"]), 2)
+            self.assertEqual(load_template.call_count, len(ip_search.templates["acc"]))
+            ip_search.library.close()
+
+    def test_descend_failures(self):
+        """Descend failures are keyed by the port context of the hier cell, not its index"""
+        with tempfile.TemporaryDirectory() as lib_dir:
+            ip_search = make_ip_search(make_library(lib_dir, [make_specimen()]))
+            g = ip_search.label_const_sources(import_design_refactor(make_flat_design(), flat=True))
+            (ver,) = ip_search.templates["adder"]
+            g_template, mapping, v_hier = self.ascend_from_adder(ip_search, g)
+            context = ip_search.port_context(g_template, mapping, v_hier)
+
+            order = list(reversed(range(g_template.vcount())))
+            g_permuted = g_template.permute_vertices(order)
+            mapping_permuted = VertexMapping({x: order[y] for x, y in mapping.items()})
+            self.assertEqual(
+                ip_search.port_context(g_permuted, mapping_permuted, order[v_hier]), context
+            )
+
+            # Taking a design vertex the descend needs leaves the port context as
+            # it is, but makes the descend fail, so the key changes
+            context = ip_search.descend_context(g, g_template, mapping, v_hier, "adder")
+            v_free = next(x for x in g.vs.select(ref="LUT6").indices if x not in mapping)
+            mapping_taken = mapping.copy()
+            mapping_taken[v_free] = g_template.vcount()
+            self.assertEqual(ip_search.port_context(g_template, mapping_taken, v_hier), context[0])
+            self.assertIsNone(
+                ip_search.descend_template(g, g_template, mapping_taken, "adder", ver, v_hier)
+            )
+            self.assertNotEqual(
+                ip_search.descend_context(g, g_template, mapping_taken, v_hier, "adder"), context
+            )
+
+            # A version known to fail in this context is not tried again
+            ip_search.descend_failures.add(("adder", ver, context))
+            _, mapping_descended, _, _, _ = ip_search.descend(g, g_template, mapping, None)
+            self.assertEqual(len(mapping_descended), len(mapping))
+            self.assertEqual(ip_search.descend_failures.hits, 1)
+            ip_search.library.close()
+
+    def test_frontier(self):
+        """Frontiers kept through descends match get_spanning_hier_cells"""
+        with tempfile.TemporaryDirectory() as lib_dir:
+            ip_search = make_ip_search(make_library(lib_dir, [make_specimen()]))
+            g = ip_search.label_const_sources(import_design_refactor(make_flat_design(), flat=True))
+            (ver,) = ip_search.templates["adder"]
+            g_template, mapping, v_hier = self.ascend_from_adder(ip_search, g)
+            frontier = Frontier(g_template, mapping.values())
+            self.assertEqual(
+                frontier.hier_cells(g_template),
+                sorted(ip_search.get_spanning_hier_cells(g_template, mapping, None)),
+            )
+            self.assertIn(v_hier, frontier.hier_cells(g_template))
+
+            spliced = Frontier(g_template, ())
+            neighbors = g_template.neighbors(v_hier)
+            g_descended, mapping_descended, new_vertices = ip_search.descend_template(
+                g, g_template, mapping, "adder", ver, v_hier
+            )
+            added = mapping_descended.added_since(len(mapping))
+            self.assertEqual(set(added), set(mapping_descended.values()) - set(mapping.values()))
+            frontier.replace(g_descended, v_hier, neighbors, added)
+            spliced.replace(g_descended, v_hier, neighbors, new_vertices)
+            for cells, limit_vertices in [(frontier, None), (spliced, new_vertices)]:
+                self.assertEqual(
+                    cells.hier_cells(g_descended),
+                    sorted(
+                        ip_search.get_spanning_hier_cells(
+                            g_descended, mapping_descended, limit_vertices
+                        )
+                    ),
+                )
+            self.assertNotIn(v_hier, frontier.hier_cells(g_descended))
+
+            # descend keeps a given frontier in step with the graph it returns
+            frontier = Frontier(g_template, mapping.values())
+            g_descended, mapping_descended, _, _, _ = ip_search.descend(
+                g, g_template, mapping, None, frontier
+            )
+            self.assertGreater(len(mapping_descended), len(mapping))
+            self.assertEqual(
+                frontier.hier_cells(g_descended),
+                sorted(ip_search.get_spanning_hier_cells(g_descended, mapping_descended, None)),
+            )
+            ip_search.library.close()
+
+    def test_graph_overlay(self):
+        with tempfile.TemporaryDirectory() as lib_dir:
+            ip_search = make_ip_search(make_library(lib_dir, [make_specimen()]))
+            g = ip_search.label_const_sources(import_design_refactor(make_flat_design(), flat=True))
+            (ver,) = ip_search.templates["adder"]
+            g_template, mapping, v_hier = self.ascend_from_adder(ip_search, g)
+            g_original = g_template.copy()
+            g_replaced, _, _ = ip_search.apply_template(
+                g_template.copy(), "adder", ver, v_hier, "descend"
+            )
+
+            overlay = GraphOverlay(g_template)
+            ip_search.apply_template(g_template, "adder", ver, v_hier, "descend", overlay)
+            self.assertEqual(g_template.vcount(), g_replaced.vcount())
+            self.assertGraphEqual(overlay.rollback(), g_original)
+
+            overlay = GraphOverlay(g_template)
+            ip_search.apply_template(g_template, "adder", ver, v_hier, "descend", overlay)
+            self.assertGraphEqual(overlay.commit(copy=True), g_replaced)
+            self.assertGraphEqual(g_template, g_original)
+            ip_search.library.close()
+
+    def test_graph_columns(self):
+        """The column views kept through trial edits match views built from scratch"""
+        with tempfile.TemporaryDirectory() as lib_dir:
+            ip_search = make_ip_search(make_library(lib_dir, [make_specimen()]))
+            g = ip_search.label_const_sources(import_design_refactor(make_flat_design(), flat=True))
+            (ver,) = ip_search.templates["adder"]
+            g_template, _, v_hier = self.ascend_from_adder(ip_search, g)
+            columns = get_columns(g_template)
+
+            overlay = GraphOverlay(g_template)
+            ip_search.apply_template(g_template, "adder", ver, v_hier, "descend", overlay)
+            self.assertIs(get_columns(g_template), columns)
+            self.assertEqual(columns.columns, GraphColumns(g_template).columns)
+            g_replaced = overlay.commit(copy=True)
+            self.assertEqual(get_columns(g_replaced).columns, GraphColumns(g_replaced).columns)
+            self.assertIs(get_columns(g_template), columns)
+            self.assertEqual(columns.columns, GraphColumns(g_template).columns)
+            ip_search.library.close()
+
+
 if __name__ == "__main__":
     unittest.main()